@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Idle (full) user buckets are dropped once this many users are tracked.
+MAX_TRACKED_USERS = 10000
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, message, code, retry_after=None):
+        super().__init__(message)
+        self.code = code
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_consume(self, amount=1):
+        self._refill()
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+    def refund(self, amount=1):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def retry_after(self, amount=1):
+        self._refill()
+        if self.tokens >= amount or not self.rate:
+            return 0.0
+        return round((amount - self.tokens) / self.rate, 1)
+
+    @property
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class AdmissionController:
+    """Per-process rate limits, concurrency slots and a bounded FIFO wait queue for chat queries."""
+
+    def __init__(self, max_concurrent=8, max_queue=32, queue_timeout=30,
+                 user_rate=0.5, user_burst=5, global_rate=20, global_burst=40,
+                 batch_rate=50, batch_burst=5000):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.batch_rate = batch_rate
+        self.batch_burst = batch_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.user_buckets = {}
+        # Batches are charged from sync views, outside the event loop that serves chat queries.
+        self.batch_buckets = {}
+        self._batch_lock = threading.Lock()
+        self.active = 0
+        self.waiters = deque()
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            max_concurrent=getattr(settings, 'CHAT_MAX_CONCURRENT_QUERIES', 8),
+            max_queue=getattr(settings, 'CHAT_MAX_QUEUED_QUERIES', 32),
+            queue_timeout=getattr(settings, 'CHAT_QUEUE_TIMEOUT', 30),
+            user_rate=getattr(settings, 'CHAT_USER_QUERY_RATE', 0.5),
+            user_burst=getattr(settings, 'CHAT_USER_QUERY_BURST', 5),
+            global_rate=getattr(settings, 'CHAT_GLOBAL_QUERY_RATE', 20),
+            global_burst=getattr(settings, 'CHAT_GLOBAL_QUERY_BURST', 40),
+            batch_rate=getattr(settings, 'BATCH_USER_QUERY_RATE', 50),
+            batch_burst=getattr(settings, 'BATCH_MAX_QUERIES', 5000),
+        )
+
+    @staticmethod
+    def _bucket(buckets, user_id, rate, burst):
+        bucket = buckets.get(user_id)
+        if bucket is None:
+            if len(buckets) >= MAX_TRACKED_USERS:
+                for idle in [uid for uid, b in buckets.items() if b.is_full]:
+                    del buckets[idle]
+            bucket = buckets[user_id] = TokenBucket(rate, burst)
+        return bucket
+
+    def _user_bucket(self, user_id):
+        return self._bucket(self.user_buckets, user_id, self.user_rate, self.user_burst)
+
+    def charge_batch(self, user_id, queries):
+        """Take one token per query from the user's batch bucket, or reject the whole batch."""
+        with self._batch_lock:
+            bucket = self._bucket(self.batch_buckets, user_id, self.batch_rate, self.batch_burst)
+            if not bucket.try_consume(queries):
+                raise AdmissionRejected("Too many batch queries, please slow down", 4010,
+                                        bucket.retry_after(queries))
+
+    def refund_batch(self, user_id, queries):
+        with self._batch_lock:
+            self._bucket(self.batch_buckets, user_id, self.batch_rate, self.batch_burst).refund(queries)
+
+    def charge(self, user_id):
+        user_bucket = self._user_bucket(user_id)
+        if not user_bucket.try_consume():
+            raise AdmissionRejected("Too many queries, please slow down", 4010, user_bucket.retry_after())
+
+        if not self.global_bucket.try_consume():
+            user_bucket.refund()
+            raise AdmissionRejected("Server is busy, please try again shortly", 4011,
+                                    self.global_bucket.retry_after())
+
+    def refund(self, user_id):
+        self._user_bucket(user_id).refund()
+        self.global_bucket.refund()
+
+    async def acquire(self, user_id, on_position=None, charge=True):
+        if charge:
+            self.charge(user_id)
+
+        if self.active < self.max_concurrent and not self.waiters:
+            self.active += 1
+            return
+
+        if len(self.waiters) >= self.max_queue:
+            logger.warning(f"Shedding query from user {user_id}: {len(self.waiters)} queued")
+            self.refund(user_id)
+            raise AdmissionRejected("Server is at capacity, please try again shortly", 4011)
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (future, on_position)
+        self.waiters.append(entry)
+        self._notify_positions()
+
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # The slot was handed to us just as we gave up; pass it on.
+                self.release()
+            elif entry in self.waiters:
+                self.waiters.remove(entry)
+                self._notify_positions()
+
+            if isinstance(e, asyncio.TimeoutError):
+                raise AdmissionRejected("Timed out waiting for a free slot", 4012)
+            raise
+
+    def release(self):
+        while self.waiters:
+            future, _ = self.waiters.popleft()
+            if not future.done():
+                # Hand the slot straight to the next waiter; ``active`` is unchanged.
+                future.set_result(True)
+                self._notify_positions()
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def admit(self, user_id, on_position=None, charge=True):
+        await self.acquire(user_id, on_position, charge)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def _notify_positions(self):
+        for position, (future, on_position) in enumerate(self.waiters, start=1):
+            if on_position is not None and not future.done():
+                asyncio.ensure_future(self._safe_notify(on_position, position))
+
+    @staticmethod
+    async def _safe_notify(on_position, position):
+        try:
+            await on_position(position)
+        except Exception as e:
+            logger.debug(f"Queue position update failed: {str(e)}")
+
+
+_controller = None
+
+
+def get_admission_controller():
+    global _controller
+    if _controller is None:
+        _controller = AdmissionController.from_settings()
+    return _controller
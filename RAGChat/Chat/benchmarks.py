@@ -0,0 +1,45 @@
+import json
+import time
+
+import numpy as np
+
+
+def load_queries(path):
+    """Load evaluation queries: a JSON list of {"query": ..., "expected": ...} objects.
+
+    ``expected`` is a snippet of text that a useful context passage must contain.
+    """
+    with open(path, encoding='utf-8') as f:
+        queries = json.load(f)
+
+    for item in queries:
+        if 'query' not in item or 'expected' not in item:
+            raise ValueError("Each query needs 'query' and 'expected' keys")
+
+    return queries
+
+
+def evaluate(search, queries):
+    """Run ``search(query) -> list[str]`` over the queries and score the retrieved contexts."""
+    latencies = []
+    hits = 0
+    reciprocal_ranks = []
+
+    for item in queries:
+        started = time.perf_counter()
+        passages = search(item['query'])
+        latencies.append((time.perf_counter() - started) * 1000)
+
+        expected = item['expected'].lower()
+        rank = next((i + 1 for i, passage in enumerate(passages) if expected in passage.lower()), None)
+        if rank:
+            hits += 1
+        reciprocal_ranks.append(1 / rank if rank else 0.0)
+
+    return {
+        'queries': len(queries),
+        'hit_rate': hits / len(queries) if queries else 0.0,
+        'mrr': float(np.mean(reciprocal_ranks)) if queries else 0.0,
+        'avg_ms': float(np.mean(latencies)) if queries else 0.0,
+        'p95_ms': float(np.percentile(latencies, 95)) if queries else 0.0,
+    }
@@ -0,0 +1,179 @@
+import re
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_core.documents import Document
+
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])\s+')
+PARAGRAPH_BOUNDARY = re.compile(r'\n\s*\n')
+NUMBERED_HEADING = re.compile(r'^\d+(\.\d+)*\.?\s+[A-Z]')
+
+
+def page_number(page):
+    """1-based page number of a PyPDFLoader page, or None when unknown."""
+    page_index = page.metadata.get('page')
+    return page_index + 1 if isinstance(page_index, int) else None
+
+
+def _make_chunk(text, page):
+    return Document(page_content=text, metadata={'page': page} if page else {})
+
+
+def _sentences(text):
+    text = ' '.join(text.split())
+    return [sentence for sentence in SENTENCE_BOUNDARY.split(text) if sentence]
+
+
+def _pack(units, chunk_size, chunk_overlap):
+    """Greedily join (text, page) units into chunks of at most chunk_size characters.
+
+    Trailing units of a full chunk, up to chunk_overlap characters, are carried
+    into the next one. Each chunk takes the page of its first unit.
+    """
+    fallback = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    chunks = []
+    current = []
+    length = 0
+
+    def flush():
+        if current:
+            chunks.append((' '.join(text for text, _ in current), current[0][1]))
+
+    for text, page in units:
+        if len(text) > chunk_size:
+            flush()
+            chunks.extend((piece, page) for piece in fallback.split_text(text))
+            current, length = [], 0
+            continue
+
+        if current and length + len(text) > chunk_size:
+            flush()
+            overlap = []
+            overlap_length = 0
+            for unit in reversed(current):
+                if overlap_length + len(unit[0]) + 1 > chunk_overlap:
+                    break
+                overlap.insert(0, unit)
+                overlap_length += len(unit[0]) + 1
+            if overlap_length + len(text) > chunk_size:
+                overlap, overlap_length = [], 0
+            current, length = overlap, overlap_length
+
+        current.append((text, page))
+        length += len(text) + 1
+
+    flush()
+    return chunks
+
+
+def _paragraph_units(text, page, chunk_size):
+    units = []
+    for paragraph in PARAGRAPH_BOUNDARY.split(text):
+        paragraph = ' '.join(paragraph.split())
+        if not paragraph:
+            continue
+        if len(paragraph) <= chunk_size:
+            units.append((paragraph, page))
+        else:
+            units.extend((sentence, page) for sentence in _sentences(paragraph))
+    return units
+
+
+def is_heading(line):
+    line = line.strip()
+    if not 2 < len(line) <= 80 or line.endswith(('.', ',', ';', ':')):
+        return False
+    if NUMBERED_HEADING.match(line):
+        return True
+    letters = [char for char in line if char.isalpha()]
+    if letters and all(char.isupper() for char in letters):
+        return True
+    return line.istitle() and len(line.split()) <= 8
+
+
+def split_recursive(pages, chunk_size, chunk_overlap):
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=len,
+        separators=["\n\n", "\n", " ", ""]
+    )
+    return [_make_chunk(chunk.page_content, page_number(chunk)) for chunk in splitter.split_documents(pages)]
+
+
+def split_sentences(pages, chunk_size, chunk_overlap):
+    """Pack whole paragraphs (or their sentences, when too long) without crossing pages."""
+    chunks = []
+    for page in pages:
+        units = _paragraph_units(page.page_content, page_number(page), chunk_size)
+        chunks.extend(_make_chunk(text, number) for text, number in _pack(units, chunk_size, chunk_overlap))
+    return chunks
+
+
+def split_pages(pages, chunk_size, chunk_overlap):
+    """One chunk per page; pages longer than twice chunk_size fall back to sentence packing."""
+    chunks = []
+    for page in pages:
+        text = page.page_content.strip()
+        if not text:
+            continue
+        if len(text) <= 2 * chunk_size:
+            chunks.append(_make_chunk(text, page_number(page)))
+        else:
+            chunks.extend(split_sentences([page], chunk_size, chunk_overlap))
+    return chunks
+
+
+def split_layout(pages, chunk_size, chunk_overlap):
+    """Start a new section at every heading line and prefix each chunk with its heading."""
+    sections = []
+    heading = ''
+    body = []
+
+    for page in pages:
+        number = page_number(page)
+        for line in page.page_content.splitlines():
+            if is_heading(line):
+                if body:
+                    sections.append((heading, body))
+                heading, body = line.strip(), []
+            elif line.strip():
+                body.append((line.strip(), number))
+    if body:
+        sections.append((heading, body))
+
+    chunks = []
+    for heading, lines in sections:
+        budget = max(chunk_size - len(heading) - 1, chunk_size // 2)
+        units = []
+        for text, number in lines:
+            units.extend((sentence, number) for sentence in _sentences(text))
+        for text, number in _pack(units, budget, chunk_overlap):
+            chunks.append(_make_chunk(f"{heading}\n{text}" if heading else text, number))
+    return chunks
+
+
+def split_auto(pages, chunk_size, chunk_overlap):
+    """Layout-aware when the document has a visible heading structure, sentence-aware otherwise."""
+    lines = [line for page in pages for line in page.page_content.splitlines() if line.strip()]
+    headings = sum(1 for line in lines if is_heading(line))
+    if lines and headings >= 3 and headings / len(lines) < 0.3:
+        return split_layout(pages, chunk_size, chunk_overlap)
+    return split_sentences(pages, chunk_size, chunk_overlap)
+
+
+CHUNKING_STRATEGIES = {
+    'recursive': split_recursive,
+    'sentence': split_sentences,
+    'page': split_pages,
+    'layout': split_layout,
+    'auto': split_auto,
+}
+
+
+def split_documents(pages, strategy='recursive', chunk_size=1000, chunk_overlap=200):
+    try:
+        splitter = CHUNKING_STRATEGIES[strategy]
+    except KeyError:
+        raise ValueError(f"Unknown chunking strategy: {strategy}")
+
+    return [chunk for chunk in splitter(pages, chunk_size, chunk_overlap) if chunk.page_content.strip()]
@@ -0,0 +1,109 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def search_channel_name(node_id):
+    """Channel served by a node's search worker (`manage.py runworker <name>`)."""
+    return f"rag-search.{node_id}"
+
+
+class RemoteSearchError(Exception):
+    """The owning node answered, but the search itself failed."""
+
+
+class HashRing:
+    """Consistent hashing of keys onto nodes, with virtual replicas for balance."""
+
+    def __init__(self, nodes, replicas=100):
+        self.nodes = sorted(set(nodes))
+        self._ring = sorted((self._hash(f"{node}#{i}"), node) for node in self.nodes for i in range(replicas))
+        self._hashes = [point for point, _ in self._ring]
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+    def get_node(self, key, exclude=()):
+        if not self._ring:
+            return None
+
+        start = bisect.bisect(self._hashes, self._hash(key))
+        for offset in range(len(self._ring)):
+            node = self._ring[(start + offset) % len(self._ring)][1]
+            if node not in exclude:
+                return node
+        return None
+
+
+class SearchRouter:
+    """Routes each (user, document) search to its owner node, skipping nodes marked down."""
+
+    def __init__(self, node_id, nodes=None, timeout=5, cooldown=30):
+        self.node_id = node_id
+        self.ring = HashRing(nodes or [node_id])
+        self.timeout = timeout
+        self.cooldown = cooldown
+        self._down_until = {}
+
+    @classmethod
+    def from_settings(cls):
+        node_id = getattr(settings, 'NODE_ID', 'local')
+        nodes = list(getattr(settings, 'CLUSTER_NODES', []))
+        if nodes and node_id not in nodes:
+            nodes.append(node_id)
+        return cls(
+            node_id,
+            nodes,
+            timeout=getattr(settings, 'CLUSTER_SEARCH_TIMEOUT', 5),
+            cooldown=getattr(settings, 'CLUSTER_NODE_COOLDOWN', 30),
+        )
+
+    @property
+    def is_clustered(self):
+        return len(self.ring.nodes) > 1
+
+    def owner(self, user_id, document_id):
+        now = time.monotonic()
+        down = {node for node, until in self._down_until.items() if until > now}
+        return self.ring.get_node(f"{user_id}:{document_id}", exclude=down) or self.node_id
+
+    def is_local(self, user_id, document_id):
+        return self.owner(user_id, document_id) == self.node_id
+
+    def mark_down(self, node_id):
+        logger.warning(f"Search node {node_id} marked down for {self.cooldown}s")
+        self._down_until[node_id] = time.monotonic() + self.cooldown
+
+    async def remote_search(self, channel_layer, node_id, user_id, document_id, query, k=4, debug=False):
+        reply_channel = await channel_layer.new_channel()
+        await channel_layer.send(search_channel_name(node_id), {
+            'type': 'rag.search',
+            'reply_channel': reply_channel,
+            'user_id': user_id,
+            'document_id': document_id,
+            'query': query,
+            'k': k,
+            'debug': debug,
+        })
+
+        message = await asyncio.wait_for(channel_layer.receive(reply_channel), self.timeout)
+        if message.get('error'):
+            raise RemoteSearchError(message['error'])
+        return message['results']
+
+
+_router = None
+
+
+def get_search_router():
+    global _router
+    if _router is None:
+        _router = SearchRouter.from_settings()
+    return _router
@@ -1,14 +1,20 @@
+import asyncio
 import json
 import logging
 
 from channels.db import database_sync_to_async
+from channels.consumer import AsyncConsumer
 from channels.generic.websocket import AsyncWebsocketConsumer
 from django.contrib.auth.models import AnonymousUser
 from asgiref.sync import sync_to_async
 
 
+from .admission import AdmissionRejected, get_admission_controller
+from .cluster import RemoteSearchError, get_search_router
+from .memory import ConversationMemory
 from .models import PDFDocument
-from .utils import RAGService, LLMService
+from .profiling import is_profiling_requested, profiling_requested
+from .utils import NO_CONTEXT_RESPONSE, RAGService, LLMService, format_context
 
 import jwt
 from django.conf import settings
@@ -35,6 +41,19 @@ class ChatConsumer(JWTAuthMixin,AsyncWebsocketConsumer):
         super().__init__(*args, **kwargs)
         self.user = None
         self.document_id = None
+        self._prefetch_task = None
+        self._release_store = None
+        self._closed = False
+        # Queries run as tasks so a disconnect is seen while they wait for a slot;
+        # the lock keeps them in order, one at a time per socket.
+        self._query_lock = asyncio.Lock()
+        self._query_tasks = set()
+        self._queued_tasks = set()
+        self.memory = ConversationMemory(
+            max_turns=getattr(settings, 'CHAT_MEMORY_MAX_TURNS', 6),
+            token_budget=getattr(settings, 'CHAT_MEMORY_TOKEN_BUDGET', 1500),
+            summary_token_budget=getattr(settings, 'CHAT_MEMORY_SUMMARY_TOKENS', 300),
+        )
 
     async def connect(self):
         try:
@@ -77,6 +96,9 @@ class ChatConsumer(JWTAuthMixin,AsyncWebsocketConsumer):
                     return
 
 
+            # Load the store while the client reads the welcome message.
+            self._prefetch_task = asyncio.ensure_future(self._prefetch_store())
+
             await self._send_message({
                 'type': 'connection_established',
                 'message': 'Connected to PDF Chat. You can now ask questions about your documents.'
@@ -90,7 +112,21 @@ class ChatConsumer(JWTAuthMixin,AsyncWebsocketConsumer):
             await self.close(code=4000)
 
     async def disconnect(self, close_code):
-        logger.info(f"WebSocket disconnected: user={self.user}, code={close_code}")
+        self._closed = True
+        for task in self._queued_tasks:
+            task.cancel()
+        await asyncio.gather(*self._query_tasks, return_exceptions=True)
+
+        if self._prefetch_task is not None:
+            # Let an in-flight load finish so its registry reference is released, not leaked.
+            await self._prefetch_task
+        if self._release_store is not None:
+            await sync_to_async(self._release_store)()
+            self._release_store = None
+
+        logger.info(f"WebSocket disconnected: user={self.user}, code={close_code}, "
+                    f"memory_turns={len(self.memory.turns)}, memory_tokens={self.memory.tokens}, "
+                    f"memory_bytes={self.memory.size_bytes()}")
 
     async def receive(self, text_data):
         try:
@@ -98,7 +134,7 @@ class ChatConsumer(JWTAuthMixin,AsyncWebsocketConsumer):
             message_type = data.get('type', 'query')
 
             if message_type == 'query':
-                await self._handle_query(data)
+                await self._submit_query(data)
             else:
                 await self._send_error(f"Unknown message type: {message_type}", 4004)
 
@@ -108,39 +144,142 @@ class ChatConsumer(JWTAuthMixin,AsyncWebsocketConsumer):
             logger.error(f"Message processing failed: {str(e)}")
             await self._send_error("Message processing failed", 4006)
 
-    async def _handle_query(self, data):
+    async def _submit_query(self, data):
         query = data.get('query', '').strip()
 
         if not query:
             await self._send_error("Query cannot be empty", 4007)
             return
 
+        # Rate limits and the per-socket cap apply on arrival, so a flood is rejected
+        # instead of turning into a backlog behind the query lock.
+        if len(self._query_tasks) >= getattr(settings, 'CHAT_MAX_PENDING_QUERIES', 2):
+            await self._send_error("Please wait for the previous answer before asking again", 4010)
+            return
+
+        try:
+            get_admission_controller().charge(self.user.id)
+        except AdmissionRejected as e:
+            logger.info(f"Query rejected for user {self.user.id}: {str(e)}")
+            await self._send_error(str(e), e.code, retry_after=e.retry_after)
+            return
+
+        task = asyncio.ensure_future(self._handle_query(query, debug=bool(data.get('debug')) and self.user.is_staff))
+        self._query_tasks.add(task)
+        task.add_done_callback(self._query_tasks.discard)
+
+    async def _handle_query(self, query, debug=False):
+        task = asyncio.current_task()
+        self._queued_tasks.add(task)
+        try:
+            async with self._query_lock:
+                async with get_admission_controller().admit(self.user.id, self._send_queue_position, charge=False):
+                    self._queued_tasks.discard(task)
+                    if self._closed:
+                        return
+                    await self._answer_query(query, debug=debug)
+        except AdmissionRejected as e:
+            logger.info(f"Query rejected for user {self.user.id}: {str(e)}")
+            await self._send_error(str(e), e.code, retry_after=e.retry_after)
+        except Exception as e:
+            logger.error(f"Message processing failed: {str(e)}")
+            await self._send_error("Message processing failed", 4006)
+        finally:
+            self._queued_tasks.discard(task)
+
+    async def _send_queue_position(self, position):
+        await self._send_message({
+            'type': 'queued',
+            'position': position,
+            'message': f'Waiting for a free slot (position {position} in queue)...'
+        })
+
+    async def _answer_query(self, query, debug=False):
         await self._send_message({
             'type': 'processing',
             'message': 'Searching documents...'
         })
 
         try:
-            rag_service = RAGService(self.user, self.document_id)
-            context_results = await sync_to_async(rag_service.search)(query)
+            if self._prefetch_task is not None:
+                await asyncio.shield(self._prefetch_task)
+
+            search_query = await self._standalone_query(query)
+
+            with profiling_requested(debug):
+                context_results = await self._search(search_query, debug=is_profiling_requested())
 
             if not context_results:
                 await self._send_message({
                     'type': 'response',
-                    'response': "I couldn't find relevant information in your documents.",
+                    'response': NO_CONTEXT_RESPONSE,
                     'complete': True
                 })
                 return
 
-            context_texts = [f"Result {res['content']}"
-                             for res in context_results]
+            context_texts = format_context(context_results)
 
-            await self._generate_streaming_response(query, context_texts, context_results)
+            response = await self._generate_streaming_response(query, context_texts, context_results)
+            if response is not None:
+                await self._remember_turn(query, response)
 
         except Exception as e:
             logger.error(f"Query processing failed: {str(e)}")
             await self._send_error(f"Failed to process query: {str(e)}", 4008)
 
+    async def _search(self, query, debug=False):
+        router = get_search_router()
+        owner = router.owner(self.user.id, self.document_id)
+
+        if owner != router.node_id and self.channel_layer is not None:
+            try:
+                return await router.remote_search(self.channel_layer, owner, self.user.id, self.document_id, query,
+                                                  debug=debug)
+            except RemoteSearchError:
+                raise
+            except Exception as e:
+                # Node lost or overloaded: mark it down and read the store from shared storage here.
+                logger.warning(f"Remote search on {owner} failed, searching locally: {e!r}")
+                router.mark_down(owner)
+
+        rag_service = RAGService(self.user, self.document_id)
+        return await sync_to_async(rag_service.search)(query)
+
+    async def _prefetch_store(self):
+        if not get_search_router().is_local(self.user.id, self.document_id):
+            return
+
+        try:
+            rag_service = RAGService(self.user, self.document_id)
+            self._release_store = await sync_to_async(rag_service.pin_vector_store)()
+        except Exception as e:
+            logger.info(f"Store prefetch skipped for user {self.user.id}: {str(e)}")
+
+    async def _standalone_query(self, query):
+        if not self.memory.has_history:
+            return query
+
+        try:
+            llm_service = LLMService()
+            return await sync_to_async(llm_service.rewrite_query)(query, self.memory)
+        except Exception as e:
+            logger.warning(f"Using original query for retrieval: {str(e)}")
+            return query
+
+    async def _remember_turn(self, query, response):
+        evicted = self.memory.add_turn(query, response)
+        if not evicted:
+            return
+
+        try:
+            llm_service = LLMService()
+            summary = await sync_to_async(llm_service.summarize)(self.memory.summary, evicted)
+        except Exception as e:
+            logger.warning(f"Falling back to extractive conversation summary: {str(e)}")
+            summary = self.memory.extractive_summary(evicted)
+
+        self.memory.set_summary(summary)
+
     async def _generate_streaming_response(self, query, context_texts, context_results):
         try:
             llm_service = LLMService()
@@ -148,6 +287,7 @@ class ChatConsumer(JWTAuthMixin,AsyncWebsocketConsumer):
             response = await sync_to_async(llm_service.generate_response)(
                 query,
                 context_texts,
+                self.memory,
             )
 
             await self._send_message({
@@ -156,6 +296,8 @@ class ChatConsumer(JWTAuthMixin,AsyncWebsocketConsumer):
                 'complete': True
             })
 
+            return response
+
         except Exception as e:
             logger.error(f"LLM generation failed: {str(e)}")
             await self._send_error(f"Failed to generate response: {str(e)}", 4009)
@@ -174,17 +316,43 @@ class ChatConsumer(JWTAuthMixin,AsyncWebsocketConsumer):
 
         await self.send(text_data=json.dumps(data))
 
-    async def _send_error(self, message, code=None):
+    async def _send_error(self, message, code=None, **extra):
         error_data = {
             'type': 'error',
             'message': message,
-            'code': code
+            'code': code,
+            **extra
         }
         await self.send(text_data=json.dumps(error_data))
 
 
+class SearchWorkerConsumer(AsyncConsumer):
+    """Serves searches routed to this node; run with `manage.py runworker rag-search.<NODE_ID>`."""
 
-
-
-
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.slots = asyncio.Semaphore(getattr(settings, 'CLUSTER_WORKER_CONCURRENCY', 8))
+        self.tasks = set()
+
+    async def rag_search(self, message):
+        # Handle searches concurrently; the consumer would otherwise take one message at a time.
+        # The event loop only keeps weak references to tasks, so hold them until they finish.
+        task = asyncio.ensure_future(self._search(message))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _search(self, message):
+        async with self.slots:
+            try:
+                user = await database_sync_to_async(User.objects.get)(id=message['user_id'])
+                rag_service = RAGService(user, message['document_id'])
+                # The sampling decision was made once, by the node that took the query.
+                with profiling_requested(bool(message.get('debug')), sample=False):
+                    results = await sync_to_async(rag_service.search)(message['query'], k=message.get('k', 4))
+                reply = {'type': 'rag.search.result', 'results': results}
+            except Exception as e:
+                logger.error(f"Routed search failed: {str(e)}")
+                reply = {'type': 'rag.search.result', 'error': str(e)}
+
+            await self.channel_layer.send(message['reply_channel'], reply)
 
@@ -0,0 +1,187 @@
+import logging
+import shutil
+import threading
+import time
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process lock, each process runs its own schedule.
+    fcntl = None
+
+from django.conf import settings
+from django.db import connections
+
+from .models import PDFDocument
+from .utils import TFIDFVectorStore, ChunkStore, store_registry
+
+logger = logging.getLogger(__name__)
+
+# Lives in MEDIA_ROOT so one process per shared media volume runs the periodic cleanup.
+LOCK_FILE = '.maintenance.lock'
+
+
+def _is_stale(path, grace_seconds):
+    try:
+        return time.time() - path.stat().st_mtime > grace_seconds
+    except FileNotFoundError:
+        return False
+
+
+def _superseded_versions(store_dir, grace_seconds):
+    current = TFIDFVectorStore.data_path(store_dir).name
+    return [
+        path for path in store_dir.iterdir()
+        if path.name not in (TFIDFVectorStore.CURRENT_FILE, current) and _is_stale(path, grace_seconds)
+    ]
+
+
+def find_orphans(grace_seconds=3600):
+    """Find stores and uploads that no PDFDocument owns, and old versions or staging leftovers of live stores.
+
+    Anything modified within ``grace_seconds`` is skipped so documents that are
+    still being processed are never touched.
+    """
+    media_root = Path(settings.MEDIA_ROOT)
+    documents = set(
+        (str(user_id), str(document_id))
+        for user_id, document_id in PDFDocument.objects.values_list('user_id', 'id')
+    )
+    uploads = set(PDFDocument.objects.values_list('pdf_file', flat=True))
+
+    orphans = {'stores': [], 'staging': [], 'uploads': []}
+
+    stores_root = media_root / 'vector_stores'
+    if stores_root.exists():
+        for user_dir in stores_root.iterdir():
+            if not user_dir.is_dir():
+                continue
+            for store_dir in user_dir.iterdir():
+                if (user_dir.name, store_dir.name) not in documents:
+                    if _is_stale(store_dir, grace_seconds):
+                        orphans['stores'].append(store_dir)
+                elif (store_dir / TFIDFVectorStore.CURRENT_FILE).exists():
+                    orphans['staging'].extend(_superseded_versions(store_dir, grace_seconds))
+
+    for upload in media_root.glob('users*/pdfs/*'):
+        if upload.is_file() and upload.relative_to(media_root).as_posix() not in uploads \
+                and _is_stale(upload, grace_seconds):
+            orphans['uploads'].append(upload)
+
+    return orphans
+
+
+def remove_orphans(orphans):
+    removed = 0
+    for path in orphans['stores'] + orphans['staging']:
+        if path.parent.parent.name == 'vector_stores':
+            store_registry.discard(path.parent.name, path.name)
+        if path.is_dir():
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            path.unlink(missing_ok=True)
+        removed += 1
+    for path in orphans['uploads']:
+        path.unlink(missing_ok=True)
+        removed += 1
+
+    stores_root = Path(settings.MEDIA_ROOT) / 'vector_stores'
+    if stores_root.exists():
+        for user_dir in stores_root.iterdir():
+            if user_dir.is_dir() and not any(user_dir.iterdir()):
+                try:
+                    user_dir.rmdir()
+                except OSError:
+                    # A new upload for this user created a store in the meantime.
+                    pass
+
+    return removed
+
+
+def find_compactable():
+    """Stores still in the pickled chunk-list layout, which load every chunk into memory."""
+    stores_root = Path(settings.MEDIA_ROOT) / 'vector_stores'
+    if not stores_root.exists():
+        return []
+    return [
+        store_dir for store_dir in stores_root.glob('*/*')
+        if (store_dir / 'documents.pkl').exists() and not ChunkStore.exists(store_dir)
+    ]
+
+
+def compact_stores(store_dirs):
+    compacted = 0
+    for store_dir in store_dirs:
+        try:
+            TFIDFVectorStore(persist_directory=str(store_dir), load_existing=True).persist()
+            compacted += 1
+        except Exception as e:
+            logger.error(f"Failed to compact vector store {store_dir}: {str(e)}")
+    return compacted
+
+
+def run_maintenance(grace_seconds=3600, dry_run=False):
+    orphans = find_orphans(grace_seconds)
+    compactable = find_compactable()
+    report = {name: len(paths) for name, paths in orphans.items()}
+    report['compactable'] = len(compactable)
+
+    if not dry_run:
+        report['removed'] = remove_orphans(orphans)
+        report['compacted'] = compact_stores(compactable)
+
+    logger.info(f"Vector store maintenance: {report}")
+    return orphans, compactable, report
+
+
+def run_maintenance_if_due(interval, grace_seconds=3600):
+    """Run maintenance unless another process holds the lock or ran it less than half an interval ago."""
+    lock_path = Path(settings.MEDIA_ROOT) / LOCK_FILE
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(lock_path, 'a+') as lock:
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+
+        lock.seek(0)
+        try:
+            last_run = float(lock.read() or 0)
+        except ValueError:
+            last_run = 0
+        if time.time() - last_run < interval / 2:
+            return False
+
+        run_maintenance(grace_seconds)
+        lock.seek(0)
+        lock.truncate()
+        lock.write(str(time.time()))
+        return True
+
+
+_maintenance_thread = None
+
+
+def start_periodic_maintenance(interval=None, grace_seconds=None):
+    """Try ``run_maintenance_if_due`` every ``interval`` seconds in a daemon thread (0 disables it)."""
+    global _maintenance_thread
+
+    interval = interval if interval is not None else getattr(settings, 'VECTOR_STORE_GC_INTERVAL', 0)
+    grace_seconds = grace_seconds if grace_seconds is not None else getattr(settings, 'VECTOR_STORE_GC_GRACE', 3600)
+    if not interval or (_maintenance_thread and _maintenance_thread.is_alive()):
+        return
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                run_maintenance_if_due(interval, grace_seconds)
+            except Exception as e:
+                logger.error(f"Vector store maintenance failed: {str(e)}")
+            finally:
+                connections.close_all()
+
+    _maintenance_thread = threading.Thread(target=loop, name='vector-store-maintenance', daemon=True)
+    _maintenance_thread.start()
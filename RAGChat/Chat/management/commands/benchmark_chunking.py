@@ -0,0 +1,55 @@
+import tempfile
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from langchain_community.document_loaders import PyPDFLoader
+
+from Chat.benchmarks import evaluate, load_queries
+from Chat.chunking import CHUNKING_STRATEGIES, split_documents
+from Chat.utils import TFIDFVectorStore
+
+
+class Command(BaseCommand):
+    help = "Measure index size, search latency and retrieval hit-rate for each chunking strategy"
+
+    def add_arguments(self, parser):
+        parser.add_argument('pdf', help="PDF file to chunk and index")
+        parser.add_argument('queries', help="JSON file with a list of {\"query\", \"expected\"} objects")
+        parser.add_argument('--strategies', nargs='+', default=list(CHUNKING_STRATEGIES), choices=list(CHUNKING_STRATEGIES))
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--chunk-overlap', type=int, default=200)
+        parser.add_argument('--k', type=int, default=4)
+
+    def handle(self, *args, **options):
+        if not Path(options['pdf']).exists():
+            raise CommandError(f"{options['pdf']} does not exist")
+
+        pages = PyPDFLoader(options['pdf']).load()
+        queries = load_queries(options['queries'])
+        self.stdout.write(f"{len(pages)} pages, {len(queries)} queries\n")
+
+        for strategy in options['strategies']:
+            chunks = split_documents(pages, strategy, options['chunk_size'], options['chunk_overlap'])
+            if not chunks:
+                self.stdout.write(f"{strategy:<10} produced no chunks")
+                continue
+
+            with tempfile.TemporaryDirectory() as directory:
+                store = TFIDFVectorStore(persist_directory=directory, load_existing=False)
+                store.add_texts([chunk.page_content for chunk in chunks], [chunk.metadata for chunk in chunks])
+                store.persist()
+                index_bytes = sum(path.stat().st_size for path in Path(directory).rglob('*') if path.is_file())
+
+                store = TFIDFVectorStore(persist_directory=directory)
+
+                def search(query):
+                    return [doc.page_content for doc in store.similarity_search(query, k=options['k'])]
+
+                stats = evaluate(search, queries)
+                prompt_chars = sum(len(chunk.page_content) for chunk in chunks) / len(chunks) * options['k']
+
+            self.stdout.write(
+                f"{strategy:<10} chunks={len(chunks):<6} index={index_bytes / 1024:.1f}KiB "
+                f"prompt~{prompt_chars:.0f}chars hit@{options['k']}={stats['hit_rate']:.3f} "
+                f"mrr={stats['mrr']:.3f} avg={stats['avg_ms']:.2f}ms p95={stats['p95_ms']:.2f}ms"
+            )
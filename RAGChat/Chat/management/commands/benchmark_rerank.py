@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from Chat.benchmarks import evaluate, load_queries
+from Chat.models import PDFDocument
+from Chat.utils import RAGService
+
+
+class Command(BaseCommand):
+    help = "Compare retrieval quality and latency with and without the re-ranking stage"
+
+    def add_arguments(self, parser):
+        parser.add_argument('document_id', type=int)
+        parser.add_argument('queries', help="JSON file with a list of {\"query\", \"expected\"} objects")
+        parser.add_argument('--k', type=int, default=4)
+
+    def handle(self, *args, **options):
+        try:
+            document = PDFDocument.objects.get(id=options['document_id'])
+        except PDFDocument.DoesNotExist:
+            raise CommandError(f"Document {options['document_id']} not found")
+
+        queries = load_queries(options['queries'])
+        if not queries:
+            raise CommandError("No queries to run")
+
+        service = RAGService(document.user, document.id)
+        # Load once so the first measured query does not pay for the cold store.
+        service.search(queries[0]['query'], k=options['k'], rerank=False)
+
+        for label, rerank in (('tfidf', False), ('tfidf+rerank', True)):
+            def search(query):
+                return [result['content'] for result in service.search(query, k=options['k'], rerank=rerank)]
+
+            stats = evaluate(search, queries)
+            self.stdout.write(
+                f"{label:<14} hit@{options['k']}={stats['hit_rate']:.3f} mrr={stats['mrr']:.3f} "
+                f"avg={stats['avg_ms']:.1f}ms p95={stats['p95_ms']:.1f}ms"
+            )
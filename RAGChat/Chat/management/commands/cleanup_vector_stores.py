@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from Chat.maintenance import run_maintenance
+
+
+class Command(BaseCommand):
+    help = "Remove orphaned vector stores, uploads and staging directories, and compact legacy stores"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only list what would be removed or compacted")
+        parser.add_argument('--grace', type=int, default=getattr(settings, 'VECTOR_STORE_GC_GRACE', 3600),
+                            help="Skip anything modified within this many seconds")
+
+    def handle(self, *args, **options):
+        orphans, compactable, report = run_maintenance(options['grace'], dry_run=options['dry_run'])
+
+        if options['verbosity'] > 1 or options['dry_run']:
+            for kind, paths in orphans.items():
+                for path in paths:
+                    self.stdout.write(f"{kind:<9} {path}")
+            for path in compactable:
+                self.stdout.write(f"compact   {path}")
+
+        self.stdout.write(self.style.SUCCESS(", ".join(f"{name}={count}" for name, count in report.items())))
@@ -0,0 +1,95 @@
+import multiprocessing
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+
+def read_memory():
+    """Resident and proportional set sizes (KiB) of this process, from /proc (Linux only)."""
+    usage = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            if name in ('Rss', 'Pss', 'Pss_Anon', 'Pss_File'):
+                usage[name] = int(value.split()[0])
+    return usage
+
+
+def worker(persist_directory, copy, ready, done, results):
+    import django
+    django.setup()
+
+    from Chat.utils import TFIDFVectorStore
+
+    before = read_memory()
+    # Loading maps the arrays read-only, exactly as store_registry does.
+    store = TFIDFVectorStore(persist_directory=persist_directory)
+    if copy:
+        # What every worker paid before stores were shared: private copies of all arrays.
+        store.vectors = store.vectors.copy()
+        blob = bytes(store.documents._blob[:])
+    else:
+        blob = store.documents._blob
+
+    # Touch every page the way searches eventually do.
+    checksum = float(np.asarray(store.vectors.data).sum()) + int(np.asarray(store.vectors.indices).sum())
+    checksum += sum(blob[i] for i in range(0, len(blob), 4096))
+
+    ready.wait()
+    after = read_memory()
+    results.put({name: after[name] - before.get(name, 0) for name in after})
+    done.wait()
+    return checksum
+
+
+def measure(persist_directory, workers, copy):
+    """Memory growth (KiB) of each of ``workers`` processes holding the store at once."""
+    context = multiprocessing.get_context('spawn')
+    ready = context.Barrier(workers)
+    done = context.Barrier(workers + 1)
+    results = context.Queue()
+    processes = [
+        context.Process(target=worker, args=(persist_directory, copy, ready, done, results))
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    usage = [results.get() for _ in processes]
+    done.wait()
+    for process in processes:
+        process.join()
+    return usage
+
+
+class Command(BaseCommand):
+    help = ("Measure the memory cost of one vector store held by N worker processes, "
+            "shared (memory-mapped) versus private copies. Linux only.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('document_id', type=int)
+        parser.add_argument('--workers', type=int, nargs='+', default=[1, 8])
+
+    def handle(self, *args, **options):
+        from Chat.models import PDFDocument
+        from Chat.utils import TFIDFVectorStore, vector_store_path
+
+        try:
+            document = PDFDocument.objects.get(id=options['document_id'])
+        except PDFDocument.DoesNotExist:
+            raise CommandError(f"Document {options['document_id']} not found")
+
+        path = vector_store_path(document.user.id, document.id)
+        if not TFIDFVectorStore.exists(path):
+            raise CommandError("Document has no vector store")
+
+        for workers in options['workers']:
+            for copy in (True, False):
+                usage = measure(str(path), workers, copy)
+                rss = sum(item.get('Rss', 0) for item in usage)
+                pss = sum(item.get('Pss', 0) for item in usage)
+                self.stdout.write(
+                    f"workers={workers:<3} {'private' if copy else 'shared':<8} "
+                    f"rss_total={rss / 1024:.1f}MiB pss_total={pss / 1024:.1f}MiB "
+                    f"pss_per_worker={pss / workers / 1024:.2f}MiB"
+                )
@@ -0,0 +1,73 @@
+import random
+from collections import OrderedDict
+
+from django.core.management.base import BaseCommand
+
+from Chat.cluster import HashRing
+
+
+class LRUCache:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+
+    def hit(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return True
+        self.entries[key] = True
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        return False
+
+
+class Command(BaseCommand):
+    help = ("Simulate per-node store cache hit rates for sticky (consistent-hash) routing "
+            "versus round-robin routing, including the loss of one node")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--nodes', type=int, nargs='+', default=[1, 2, 4, 8])
+        parser.add_argument('--documents', type=int, default=2000, help="Distinct (user, document) pairs")
+        parser.add_argument('--requests', type=int, default=100000)
+        parser.add_argument('--cache-size', type=int, default=128, help="Stores cached per node")
+        parser.add_argument('--skew', type=float, default=1.1, help="Zipf exponent of document popularity")
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        keys = [f"{rng.randrange(1000)}:{document}" for document in range(options['documents'])]
+        weights = [1 / (rank + 1) ** options['skew'] for rank in range(len(keys))]
+        workload = rng.choices(keys, weights=weights, k=options['requests'])
+
+        for count in options['nodes']:
+            nodes = [f"node-{i}" for i in range(count)]
+            ring = HashRing(nodes)
+
+            sticky = self._hit_rate(workload, nodes, lambda key, i: ring.get_node(key), options['cache_size'])
+            round_robin = self._hit_rate(workload, nodes, lambda key, i: nodes[i % count], options['cache_size'])
+
+            line = (f"nodes={count:<3} sticky={sticky:.3f} round_robin={round_robin:.3f} "
+                    f"aggregate_cache={count * options['cache_size']}")
+
+            if count > 1:
+                # Lose one node halfway through; only its keys move to their ring successors.
+                lost = nodes[-1]
+                half = len(workload) // 2
+
+                def route_with_loss(key, i):
+                    return ring.get_node(key, exclude=(lost,) if i >= half else ())
+
+                after_loss = self._hit_rate(workload, nodes, route_with_loss, options['cache_size'], start=half)
+                line += f" sticky_after_losing_one={after_loss:.3f}"
+
+            self.stdout.write(line)
+
+    @staticmethod
+    def _hit_rate(workload, nodes, route, cache_size, start=0):
+        caches = {node: LRUCache(cache_size) for node in nodes}
+        hits = 0
+        for i, key in enumerate(workload):
+            hit = caches[route(key, i)].hit(key)
+            if i >= start:
+                hits += hit
+        return hits / (len(workload) - start)
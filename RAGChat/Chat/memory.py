@@ -0,0 +1,76 @@
+import sys
+from collections import deque
+
+
+def estimate_tokens(text):
+    """Rough token count (about four characters per token), good enough for budgeting."""
+    return len(text) // 4 + 1
+
+
+class ConversationMemory:
+    """Bounded chat history for a single WebSocket connection.
+
+    Recent turns are kept in a ring buffer limited by both turn count and a
+    token budget. Turns pushed out of the buffer are returned by ``add_turn``
+    so the caller can fold them into ``summary``, which has its own budget.
+    """
+
+    def __init__(self, max_turns=6, token_budget=1500, summary_token_budget=300):
+        self.max_turns = max_turns
+        self.token_budget = token_budget
+        self.summary_token_budget = summary_token_budget
+        self.turns = deque()
+        self.summary = ''
+        self._turn_tokens = 0
+
+    @property
+    def has_history(self):
+        return bool(self.turns or self.summary)
+
+    @property
+    def tokens(self):
+        return self._turn_tokens + (estimate_tokens(self.summary) if self.summary else 0)
+
+    def add_turn(self, question, answer):
+        tokens = estimate_tokens(question) + estimate_tokens(answer)
+        self.turns.append((question, answer, tokens))
+        self._turn_tokens += tokens
+
+        evicted = []
+        while self.turns and (len(self.turns) > self.max_turns or self._turn_tokens > self.token_budget):
+            old_question, old_answer, old_tokens = self.turns.popleft()
+            self._turn_tokens -= old_tokens
+            evicted.append((old_question, old_answer))
+
+        return evicted
+
+    def set_summary(self, summary):
+        max_chars = self.summary_token_budget * 4
+        summary = summary.strip()
+        if len(summary) > max_chars:
+            # Keep the most recent part; older context matters least.
+            summary = summary[-max_chars:].split(' ', 1)[-1]
+        self.summary = summary
+
+    def extractive_summary(self, evicted):
+        """Cheap fallback when the LLM summary is unavailable: keep the questions asked."""
+        asked = " ".join(f"User asked: {question}" for question, _ in evicted)
+        return f"{self.summary} {asked}".strip()
+
+    def history(self):
+        return [(question, answer) for question, answer, _ in self.turns]
+
+    def format_history(self):
+        lines = []
+        if self.summary:
+            lines.append(f"Summary of earlier conversation: {self.summary}")
+        for question, answer in self.history():
+            lines.append(f"User: {question}")
+            lines.append(f"Assistant: {answer}")
+        return "\n".join(lines)
+
+    def size_bytes(self):
+        size = sys.getsizeof(self.turns) + sys.getsizeof(self.summary)
+        for question, answer, _ in self.turns:
+            size += sys.getsizeof(question) + sys.getsizeof(answer)
+        return size
@@ -23,6 +23,7 @@ class PDFDocument(models.Model):
 class DocumentChunk(models.Model):
     document = models.ForeignKey(PDFDocument, on_delete=models.CASCADE, related_name='chunks')
     text = models.TextField()
+    page = models.PositiveIntegerField(null=True, blank=True)
 
 
 
@@ -0,0 +1,96 @@
+import contextvars
+import cProfile
+import functools
+import logging
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_requested = contextvars.ContextVar('profiling_requested', default=False)
+_active = contextvars.ContextVar('profiling_active', default=False)
+_rotate_lock = threading.Lock()
+
+
+@contextmanager
+def profiling_requested(enabled=True, sample=True):
+    """Profile every hooked call made inside this block (including via sync_to_async).
+
+    Wrap each request entry point: a request that did not ask for profiling is
+    sampled here, once, so its hooks are profiled all together or not at all.
+    """
+    if not enabled and sample:
+        sample_rate = getattr(settings, 'PROFILING_SAMPLE_RATE', 0.0)
+        enabled = sample_rate > 0 and random.random() < sample_rate
+
+    token = _requested.set(bool(enabled))
+    try:
+        yield
+    finally:
+        _requested.reset(token)
+
+
+def is_profiling_requested():
+    return _requested.get()
+
+
+def _should_profile():
+    return _requested.get() and not _active.get()
+
+
+def profile_hook(name):
+    """Run the decorated function under cProfile inside a profiled request.
+
+    Unprofiled calls only pay for a context-variable lookup. Profiles are
+    written as pstats files.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _should_profile():
+                return func(*args, **kwargs)
+
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiler is already running in this process.
+                return func(*args, **kwargs)
+
+            token = _active.set(True)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.disable()
+                _active.reset(token)
+                _dump(profiler, name, time.perf_counter() - started)
+
+        return wrapper
+    return decorator
+
+
+def _dump(profiler, name, elapsed):
+    directory = Path(getattr(settings, 'PROFILING_DIR', Path(settings.BASE_DIR) / 'profiles'))
+    try:
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / f"{time.strftime('%Y%m%d-%H%M%S')}-{name}-{elapsed * 1000:.0f}ms-{uuid.uuid4().hex[:8]}.prof"
+        profiler.dump_stats(path)
+        _rotate(directory)
+        logger.info(f"Profile for {name} written to {path}")
+    except Exception as e:
+        logger.error(f"Failed to write profile for {name}: {str(e)}")
+
+
+def _rotate(directory):
+    max_files = getattr(settings, 'PROFILING_MAX_FILES', 200)
+    with _rotate_lock:
+        profiles = sorted(directory.glob('*.prof'), key=lambda path: path.stat().st_mtime)
+        for old_profile in profiles[:-max_files] if max_files else profiles:
+            old_profile.unlink(missing_ok=True)
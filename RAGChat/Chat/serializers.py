@@ -1,3 +1,4 @@
+from django.conf import settings
 from rest_framework import serializers
 from django.contrib.auth.models import User
 from .models import PDFDocument
@@ -24,6 +25,10 @@ class PDFUploadedSerializer(serializers.Serializer):
         required=False,
         max_length=255,
     )
+    debug = serializers.BooleanField(
+        required=False,
+        default=False,
+    )
 
     def validate_file(self,value):
         if not value.name.lower().endswith('.pdf'):
@@ -41,4 +46,29 @@ class ChatQuerySerializer(serializers.Serializer):
     )
     document_id = serializers.UUIDField(
         required=False
-    )
\ No newline at end of file
+    )
+
+class BatchQuerySerializer(serializers.Serializer):
+    queries = serializers.ListField(
+        child=serializers.CharField(max_length=1000),
+        allow_empty=False,
+        max_length=getattr(settings, 'BATCH_MAX_QUERIES', 5000),
+    )
+    document_ids = serializers.ListField(
+        child=serializers.IntegerField(),
+        required=False,
+    )
+    k = serializers.IntegerField(
+        required=False,
+        default=4,
+        min_value=1,
+        max_value=20,
+    )
+    generate = serializers.BooleanField(
+        required=False,
+        default=True,
+    )
+    rerank = serializers.BooleanField(
+        required=False,
+        default=True,
+    )
@@ -0,0 +1,22 @@
+import logging
+import shutil
+
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from .models import PDFDocument
+from .utils import store_registry, vector_store_path
+
+logger = logging.getLogger(__name__)
+
+
+@receiver(post_delete, sender=PDFDocument)
+def remove_document_files(sender, instance, **kwargs):
+    store_registry.discard(instance.user_id, instance.id)
+    shutil.rmtree(vector_store_path(instance.user_id, instance.id), ignore_errors=True)
+
+    if instance.pdf_file:
+        try:
+            instance.pdf_file.delete(save=False)
+        except Exception as e:
+            logger.error(f"Failed to delete PDF for document {instance.id}: {str(e)}")
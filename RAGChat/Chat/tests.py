@@ -1,3 +1,817 @@
-from django.test import TestCase
+import asyncio
+import json
+import threading
+import os
+import random
+import shutil
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+import jwt
+from asgiref.sync import sync_to_async
+from channels.layers import InMemoryChannelLayer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase, override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+from langchain_core.documents import Document as PDFPage
+
+from Chat.admission import AdmissionController, AdmissionRejected, TokenBucket
+from Chat.benchmarks import evaluate
+from Chat.chunking import _pack, is_heading, page_number, split_documents
+from Chat.cluster import RemoteSearchError, SearchRouter, search_channel_name
+from Chat.consumers import ChatConsumer, SearchWorkerConsumer
+from Chat.maintenance import find_orphans, remove_orphans, run_maintenance_if_due
+from Chat.management.commands.measure_store_memory import measure
+from Chat.memory import ConversationMemory, estimate_tokens
+from Chat.models import PDFDocument
+from Chat.profiling import profile_hook, profiling_requested
+from Chat.utils import (BatchRAGService, ProximityReranker, RAGService, StoreRegistry, TFIDFVectorStore,
+                        store_registry, vector_store_path)
+from Chat.views import BatchQueryAPI
+
+# Each query has a distractor that repeats the query terms apart (higher TF-IDF)
+# and a target that contains them as a phrase.
+RERANK_PASSAGES = [
+    "Model trains run on time. The machine shop builds each model. Learning the model names helps; "
+    "machine parts and model kits sell well.",
+    "We trained a machine learning model on customer reviews to predict churn.",
+    "Credit is scarce this year; the card reader failed and credit terms printed on the card changed.",
+    "Customers can pay with a credit card at the front desk.",
+    "Power cables arrive by truck; the supply depot stores power tools and supply crates.",
+    "A backup power supply keeps the servers running during outages.",
+    "Gardening tips for spring: water plants early and prune dead branches.",
+    "A washing machine uses less water on the eco cycle.",
+]
+RERANK_QUERIES = [
+    {'query': "machine learning model", 'expected': "customer reviews"},
+    {'query': "credit card", 'expected': "front desk"},
+    {'query': "power supply", 'expected': "backup"},
+]
+
+
+class ProximityRerankerTests(SimpleTestCase):
+    def setUp(self):
+        self.store = TFIDFVectorStore().add_texts(RERANK_PASSAGES)
+
+    def search(self, query, rerank):
+        results = self.store.similarity_search_with_score(query, k=len(RERANK_PASSAGES))
+        if rerank:
+            results = ProximityReranker(self.store.analyzer).rerank(query, results, budget_ms=1000)
+        return [doc.page_content for doc, _ in results]
+
+    def test_promotes_phrase_match_over_bag_of_words_match(self):
+        plain = self.search("machine learning model", rerank=False)
+        reranked = self.search("machine learning model", rerank=True)
+
+        self.assertTrue(plain[0].startswith("Model trains"))
+        self.assertTrue(reranked[0].startswith("We trained a machine learning model"))
+
+    def test_rerank_improves_mrr(self):
+        plain = evaluate(lambda query: self.search(query, rerank=False), RERANK_QUERIES)
+        reranked = evaluate(lambda query: self.search(query, rerank=True), RERANK_QUERIES)
+
+        self.assertEqual(plain['mrr'], 0.5)
+        self.assertEqual(reranked['mrr'], 1.0)
+
+    def test_zero_budget_keeps_first_stage_order(self):
+        results = self.store.similarity_search_with_score("power supply", k=4)
+        reranked = ProximityReranker(self.store.analyzer).rerank("power supply", results, budget_ms=0)
+        self.assertEqual(reranked, results)
+
+
+class ConversationMemoryTests(SimpleTestCase):
+    def test_evicts_oldest_turns_beyond_max_turns(self):
+        memory = ConversationMemory(max_turns=2, token_budget=1000)
+        self.assertEqual(memory.add_turn("q1", "a1"), [])
+        self.assertEqual(memory.add_turn("q2", "a2"), [])
+        self.assertEqual(memory.add_turn("q3", "a3"), [("q1", "a1")])
+        self.assertEqual(memory.history(), [("q2", "a2"), ("q3", "a3")])
+
+    def test_evicts_to_stay_within_token_budget(self):
+        memory = ConversationMemory(max_turns=10, token_budget=60)
+        memory.add_turn("short", "answer")
+        evicted = memory.add_turn("long question", "x" * 220)
+
+        self.assertEqual(evicted[0], ("short", "answer"))
+        self.assertLessEqual(memory.tokens, 60)
+
+    def test_oversized_turn_leaves_buffer_empty(self):
+        memory = ConversationMemory(max_turns=10, token_budget=10)
+        evicted = memory.add_turn("q", "y" * 400)
+
+        self.assertEqual(evicted, [("q", "y" * 400)])
+        self.assertFalse(memory.turns)
+        self.assertEqual(memory.tokens, 0)
+
+    def test_summary_is_capped_at_word_boundary(self):
+        memory = ConversationMemory(summary_token_budget=5)
+        memory.set_summary("alpha beta gamma delta epsilon zeta eta theta")
+
+        self.assertLessEqual(len(memory.summary), 20)
+        self.assertTrue("alpha beta gamma delta epsilon zeta eta theta".endswith(memory.summary))
+        self.assertFalse(memory.summary.startswith(" "))
+        self.assertEqual(memory.tokens, estimate_tokens(memory.summary))
+
+    def test_extractive_summary_keeps_questions(self):
+        memory = ConversationMemory()
+        memory.set_summary("Earlier.")
+        summary = memory.extractive_summary([("What is X?", "X is..."), ("And Y?", "Y is...")])
+
+        self.assertEqual(summary, "Earlier. User asked: What is X? User asked: And Y?")
+
+    def test_format_history_and_size(self):
+        memory = ConversationMemory()
+        self.assertFalse(memory.has_history)
+        memory.add_turn("q", "a")
+
+        self.assertTrue(memory.has_history)
+        self.assertEqual(memory.format_history(), "User: q\nAssistant: a")
+        self.assertGreater(memory.size_bytes(), 0)
+
+
+LAYOUT_PAGE = """1. Introduction
+The reactor vessel holds the core.
+Coolant flows upward through the channels.
+Heat leaves through the exchanger.
+SAFETY SYSTEMS
+Backup pumps start automatically on loss of pressure.
+Operators confirm the alarm.
+Sensors report every second.
+Maintenance Schedule
+Valves are inspected every quarter.
+Seals are replaced yearly.
+Filters are cleaned monthly."""
+
+
+class ChunkingTests(SimpleTestCase):
+    def test_page_number_is_one_based(self):
+        self.assertEqual(page_number(PDFPage(page_content="x", metadata={'page': 0})), 1)
+        self.assertEqual(page_number(PDFPage(page_content="x", metadata={'page': 4})), 5)
+        self.assertIsNone(page_number(PDFPage(page_content="x", metadata={})))
+
+    def test_is_heading(self):
+        for line in ("1. Introduction", "2.3 Results", "SAFETY SYSTEMS", "Maintenance Schedule"):
+            self.assertTrue(is_heading(line), line)
+        for line in ("The reactor vessel holds the core.", "Note:", "ab", "word " * 30):
+            self.assertFalse(is_heading(line), line)
+
+    def test_pack_respects_size_and_carries_overlap(self):
+        units = [(f"sentence number {i}.", 1) for i in range(10)]
+        chunks = _pack(units, chunk_size=60, chunk_overlap=25)
+
+        self.assertGreater(len(chunks), 1)
+        for text, _ in chunks:
+            self.assertLessEqual(len(text), 60)
+        for (previous, _), (current, _) in zip(chunks, chunks[1:]):
+            self.assertEqual(current.split(".")[0], previous.split(". ")[-1].rstrip("."))
+
+    def test_pack_splits_oversized_unit_and_keeps_first_page(self):
+        chunks = _pack([("a" * 10, 1), ("word " * 40, 2)], chunk_size=50, chunk_overlap=0)
+
+        self.assertEqual(chunks[0], ("a" * 10, 1))
+        self.assertTrue(all(page == 2 for _, page in chunks[1:]))
+        self.assertTrue(all(len(text) <= 50 for text, _ in chunks))
+
+    def test_every_strategy_keeps_text_and_pages(self):
+        pages = [
+            PDFPage(page_content="Alpha beta gamma. Delta epsilon zeta.", metadata={'page': 0}),
+            PDFPage(page_content="Eta theta iota. Kappa lambda mu.", metadata={'page': 1}),
+        ]
+        for strategy in ('recursive', 'sentence', 'page', 'layout', 'auto'):
+            chunks = split_documents(pages, strategy, chunk_size=200, chunk_overlap=0)
+            text = " ".join(chunk.page_content for chunk in chunks)
+
+            self.assertIn("Alpha", text, strategy)
+            self.assertIn("Kappa", text, strategy)
+            self.assertEqual(chunks[0].metadata, {'page': 1}, strategy)
+            if strategy != 'layout':
+                # Layout sections may run across pages; the others never do.
+                self.assertEqual(chunks[-1].metadata, {'page': 2}, strategy)
+
+    def test_sentence_strategy_never_splits_sentences(self):
+        page = PDFPage(page_content=" ".join(f"Sentence {i} ends here." for i in range(20)), metadata={'page': 0})
+        chunks = split_documents([page], 'sentence', chunk_size=80, chunk_overlap=0)
+
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertTrue(chunk.page_content.endswith("ends here."))
+
+    def test_layout_strategy_prefixes_headings(self):
+        page = PDFPage(page_content=LAYOUT_PAGE, metadata={'page': 0})
+        chunks = split_documents([page], 'layout', chunk_size=200, chunk_overlap=0)
+
+        self.assertEqual([chunk.page_content.split("\n")[0] for chunk in chunks],
+                         ["1. Introduction", "SAFETY SYSTEMS", "Maintenance Schedule"])
+        self.assertEqual(split_documents([page], 'auto', 200, 0), chunks)
+
+    def test_unknown_strategy(self):
+        with self.assertRaises(ValueError):
+            split_documents([], 'semantic')
+
+    def test_store_treats_page_zero_as_unknown(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = TFIDFVectorStore(persist_directory=directory, load_existing=False)
+            store.add_texts(["pumps and valves", "reactor core"], [{'page': 3}, {}])
+            store.persist()
+            store = TFIDFVectorStore(persist_directory=directory)
+
+            self.assertEqual(store.get_document(0).metadata, {'page': 3})
+            self.assertEqual(store.get_document(1).metadata, {})
+
+
+class TokenBucketTests(SimpleTestCase):
+    def test_burst_then_reject_and_refund(self):
+        bucket = TokenBucket(rate=0, capacity=2)
+
+        self.assertTrue(bucket.try_consume())
+        self.assertTrue(bucket.try_consume())
+        self.assertFalse(bucket.try_consume())
+        bucket.refund()
+        self.assertTrue(bucket.try_consume())
+
+    def test_retry_after(self):
+        bucket = TokenBucket(rate=2, capacity=1)
+        bucket.try_consume()
+
+        self.assertGreater(bucket.retry_after(), 0)
+        self.assertLessEqual(bucket.retry_after(), 0.5)
+        self.assertFalse(bucket.is_full)
+
+
+class AdmissionControllerTests(SimpleTestCase):
+    def controller(self, **kwargs):
+        options = dict(max_concurrent=1, max_queue=2, queue_timeout=5,
+                       user_rate=0, user_burst=10, global_rate=0, global_burst=10)
+        options.update(kwargs)
+        return AdmissionController(**options)
+
+    async def test_rejects_user_over_rate(self):
+        controller = self.controller(user_burst=1)
+        await controller.acquire(1)
+
+        with self.assertRaises(AdmissionRejected) as raised:
+            await controller.acquire(1)
+        self.assertEqual(raised.exception.code, 4010)
+        self.assertEqual(controller.global_bucket.tokens, 9)
+
+    async def test_rejects_over_global_rate_and_refunds_user(self):
+        controller = self.controller(global_burst=1)
+        await controller.acquire(1)
+
+        with self.assertRaises(AdmissionRejected) as raised:
+            await controller.acquire(2)
+        self.assertEqual(raised.exception.code, 4011)
+        self.assertEqual(controller.user_buckets[2].tokens, 10)
+
+    async def test_queues_in_order_and_reports_positions(self):
+        controller = self.controller()
+        positions = []
+        order = []
+
+        async def on_position(position):
+            positions.append(position)
+
+        async def query(name):
+            async with controller.admit(name, on_position):
+                order.append(name)
+
+        await controller.acquire('first')
+        waiting = [asyncio.ensure_future(query('second')), asyncio.ensure_future(query('third'))]
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        self.assertEqual(len(controller.waiters), 2)
+        self.assertIn(2, positions)
+
+        controller.release()
+        await asyncio.gather(*waiting)
+        self.assertEqual(order, ['second', 'third'])
+        self.assertEqual(controller.active, 0)
+
+    async def test_sheds_when_queue_full_and_refunds_tokens(self):
+        controller = self.controller(max_queue=1)
+        await controller.acquire(1)
+        waiting = asyncio.ensure_future(controller.acquire(2))
+        await asyncio.sleep(0)
+
+        with self.assertRaises(AdmissionRejected) as raised:
+            await controller.acquire(3)
+        self.assertEqual(raised.exception.code, 4011)
+        self.assertEqual(controller.user_buckets[3].tokens, 10)
+        self.assertEqual(controller.global_bucket.tokens, 8)
+
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        self.assertFalse(controller.waiters)
+
+    async def test_queue_timeout(self):
+        controller = self.controller(queue_timeout=0.01)
+        await controller.acquire(1)
+
+        with self.assertRaises(AdmissionRejected) as raised:
+            await controller.acquire(2)
+        self.assertEqual(raised.exception.code, 4012)
+        self.assertFalse(controller.waiters)
+        self.assertEqual(controller.active, 1)
+
+    def test_charges_batches_per_query(self):
+        controller = self.controller(batch_rate=1, batch_burst=100)
+        controller.charge_batch(1, 60)
+
+        with self.assertRaises(AdmissionRejected) as raised:
+            controller.charge_batch(1, 60)
+        self.assertEqual(raised.exception.code, 4010)
+        self.assertGreater(raised.exception.retry_after, 15)
+        controller.charge_batch(2, 100)
+
+
+class ChatConsumerAdmissionTests(SimpleTestCase):
+    def setUp(self):
+        self.controller = AdmissionController(max_concurrent=1, max_queue=4, user_rate=0, user_burst=10,
+                                              global_rate=0, global_burst=10)
+        patcher = mock.patch('Chat.consumers.get_admission_controller', return_value=self.controller)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.sent = []
+        self.answered = []
+        self.answer_released = None
+        self.consumer = ChatConsumer()
+        self.consumer.user = mock.Mock(id=1, is_staff=False)
+        self.consumer.send = self.send
+        self.consumer._answer_query = self.answer
+
+    async def send(self, text_data=None, **kwargs):
+        self.sent.append(json.loads(text_data))
+
+    async def answer(self, query, debug=False):
+        self.answered.append(query)
+        await self.answer_released.wait()
+
+    async def ask(self, *queries):
+        for query in queries:
+            await self.consumer.receive(json.dumps({'query': query}))
+        await asyncio.sleep(0.01)
+
+    def error_codes(self):
+        return [message['code'] for message in self.sent if message['type'] == 'error']
+
+    async def test_flood_on_one_socket_is_rejected_on_arrival(self):
+        self.answer_released = asyncio.Event()
+        await self.ask('q0', 'q1', 'q2', 'q3', 'q4')
+
+        self.assertEqual(self.error_codes(), [4010, 4010, 4010])
+        self.assertEqual(self.controller.user_buckets[1].tokens, 8)
+
+        self.answer_released.set()
+        await asyncio.gather(*self.consumer._query_tasks)
+        self.assertEqual(self.answered, ['q0', 'q1'])
+        self.assertEqual(self.controller.active, 0)
+
+    async def test_user_rate_is_charged_before_queueing(self):
+        self.answer_released = asyncio.Event()
+        self.controller.user_burst = 1
+        await self.ask('q0', 'q1')
+
+        self.assertEqual(self.error_codes(), [4010])
+        self.assertEqual(len(self.consumer._query_tasks), 1)
+        self.answer_released.set()
+        await asyncio.gather(*self.consumer._query_tasks)
+
+    async def test_disconnect_cancels_queued_queries(self):
+        self.answer_released = asyncio.Event()
+        await self.controller.acquire(99)
+        await self.ask('q0', 'q1')
+        self.assertEqual(len(self.controller.waiters), 1)
+
+        await self.consumer.disconnect(1000)
+
+        self.assertFalse(self.consumer._query_tasks)
+        self.assertFalse(self.controller.waiters)
+        self.assertEqual(self.answered, [])
+        self.controller.release()
+        self.assertEqual(self.controller.active, 0)
+
+
+class StorePersistTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def save(self, texts):
+        store = TFIDFVectorStore(persist_directory=self.directory, load_existing=False)
+        store.add_texts(texts)
+        store.persist()
+
+    def test_save_publishes_a_new_version_and_retires_the_old_one(self):
+        self.save(["pumps and valves"])
+        first = TFIDFVectorStore.data_path(self.directory)
+        reader = TFIDFVectorStore(persist_directory=self.directory)
+
+        self.save(["reactor core", "coolant loop"])
+        second = TFIDFVectorStore.data_path(self.directory)
+
+        self.assertNotEqual(first, second)
+        self.assertEqual(sorted(os.listdir(self.directory)), sorted([TFIDFVectorStore.CURRENT_FILE, second.name]))
+        # Files already mapped by a reader outlive the retired version.
+        self.assertEqual(reader.get_document(0).page_content, "pumps and valves")
+        self.assertEqual(len(TFIDFVectorStore(persist_directory=self.directory).documents), 2)
+
+    def test_load_retries_when_its_version_is_retired(self):
+        self.save(["pumps and valves"])
+        retired = Path(self.directory) / 'v-retired'
+        resolve = TFIDFVectorStore.data_path.__func__
+        answers = iter([retired])
+
+        def data_path(cls, directory):
+            return next(answers, None) or resolve(cls, directory)
+
+        store = TFIDFVectorStore(persist_directory=self.directory, load_existing=False)
+        with mock.patch.object(TFIDFVectorStore, 'data_path', classmethod(data_path)):
+            store.load()
+
+        self.assertEqual(store.get_document(0).page_content, "pumps and valves")
+
+    def test_flat_store_is_converted_on_save(self):
+        self.save(["pumps and valves"])
+        version = TFIDFVectorStore.data_path(self.directory)
+        for path in version.iterdir():
+            path.rename(Path(self.directory) / path.name)
+        version.rmdir()
+        os.remove(Path(self.directory) / TFIDFVectorStore.CURRENT_FILE)
+
+        store = TFIDFVectorStore(persist_directory=self.directory)
+        self.assertEqual(store.get_document(0).page_content, "pumps and valves")
+        store.persist()
+
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+        self.assertTrue(TFIDFVectorStore.exists(self.directory))
+
+
+class DocumentStoreTestCase(TestCase):
+    """A user with one document in a temporary MEDIA_ROOT; STORE_TEXTS, when set, are indexed for it."""
+
+    STORE_TEXTS = None
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root, PROFILING_DIR=Path(media_root) / 'profiles')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = get_user_model().objects.create(username='reader')
+        self.document = PDFDocument.objects.create(user=self.user, title='manual', pdf_file='manual.pdf')
+        self.store_dir = vector_store_path(self.user.id, self.document.id)
+        if self.STORE_TEXTS:
+            self.build_store(self.STORE_TEXTS)
+
+    def build_store(self, texts, document=None):
+        document = document or self.document
+        store = TFIDFVectorStore(persist_directory=str(vector_store_path(self.user.id, document.id)),
+                                 load_existing=False)
+        store.add_texts(texts)
+        store.persist()
+
+
+class StoreRegistryTests(DocumentStoreTestCase):
+    STORE_TEXTS = ["pumps and valves", "reactor core"]
+
+    def test_acquire_retries_when_its_version_is_retired(self):
+        registry = StoreRegistry()
+        resolve = TFIDFVectorStore.data_path.__func__
+        answers = iter([self.store_dir / 'v-retired'])
+
+        def data_path(cls, directory):
+            return next(answers, None) or resolve(cls, directory)
+
+        with mock.patch.object(TFIDFVectorStore, 'data_path', classmethod(data_path)):
+            with registry.attach(self.user.id, self.document.id) as store:
+                self.assertEqual(len(store.documents), 2)
+
+    def test_reload_after_save(self):
+        registry = StoreRegistry()
+        with registry.attach(self.user.id, self.document.id) as first:
+            pass
+        self.build_store(["coolant loop"])
+
+        with registry.attach(self.user.id, self.document.id) as second:
+            self.assertIsNot(first, second)
+            self.assertEqual(second.get_document(0).page_content, "coolant loop")
+
+
+class StorePrefetchTests(DocumentStoreTestCase):
+    STORE_TEXTS = ["pumps and valves", "reactor core"]
+
+    def setUp(self):
+        super().setUp()
+        store_registry.discard(self.user.id, self.document.id)
+        self.addCleanup(store_registry.discard, self.user.id, self.document.id)
+
+    def refs(self):
+        entry = store_registry._entries.get((str(self.user.id), str(self.document.id)))
+        return entry['refs'] if entry else 0
+
+    async def connect(self, document_id=None):
+        token = jwt.encode({'user_id': self.user.id}, settings.SECRET_KEY, algorithm='HS256')
+        path = f"/ws/chat/?token={token}" + (f"&document_id={document_id}" if document_id else "")
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), path)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        welcome = await communicator.receive_json_from()
+        self.assertEqual(welcome['type'], 'connection_established')
+        return communicator
+
+    async def test_connection_pins_warm_store_until_disconnect(self):
+        communicator = await self.connect(self.document.id)
+        await asyncio.sleep(0.2)
+
+        self.assertEqual(self.refs(), 1)
+        entry = store_registry._entries[(str(self.user.id), str(self.document.id))]
+        self.assertTrue(entry['store']._warm)
+
+        await communicator.disconnect()
+        self.assertEqual(self.refs(), 0)
+
+    async def test_disconnect_during_prefetch_releases_the_store(self):
+        started = threading.Event()
+        warm_up = TFIDFVectorStore.warm_up
+
+        def slow_warm_up(store):
+            started.set()
+            time.sleep(0.3)
+            warm_up(store)
+
+        with mock.patch.object(TFIDFVectorStore, 'warm_up', slow_warm_up):
+            communicator = await self.connect(self.document.id)
+            await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+            await communicator.disconnect()
+
+        self.assertEqual(self.refs(), 0)
+
+    async def test_connection_without_document_or_store_does_not_pin(self):
+        pending = await PDFDocument.objects.acreate(user=self.user, title='processing', pdf_file='pending.pdf')
+
+        for document_id in (None, pending.id):
+            communicator = await self.connect(document_id)
+            await asyncio.sleep(0.1)
+            await communicator.disconnect()
+
+        self.assertEqual(self.refs(), 0)
+        self.assertNotIn((str(self.user.id), str(pending.id)), store_registry._entries)
+
+    def test_warm_up_runs_once_per_store(self):
+        release = RAGService(self.user, self.document.id).pin_vector_store()
+        self.addCleanup(release)
+        store = store_registry.acquire(self.user.id, self.document.id)
+        self.addCleanup(store_registry.release, self.user.id, self.document.id, store)
+
+        with mock.patch.object(store, 'similarity_search_with_score') as search:
+            store.warm_up()
+            RAGService(self.user, self.document.id).pin_vector_store()()
+        search.assert_not_called()
+        self.assertEqual(self.refs(), 2)
+
+
+class MaintenanceTests(DocumentStoreTestCase):
+    def test_finds_old_versions_and_unowned_stores(self):
+        self.build_store(["pumps and valves"])
+        old_version = self.store_dir / 'v-old'
+        old_version.mkdir()
+        unowned = self.store_dir.parent / '999'
+        unowned.mkdir()
+        stale = time.time() - 7200
+        for path in (old_version, unowned):
+            os.utime(path, (stale, stale))
+
+        orphans = find_orphans(grace_seconds=3600)
+
+        self.assertEqual(orphans['staging'], [old_version])
+        self.assertEqual(orphans['stores'], [unowned])
+        self.assertEqual(remove_orphans(orphans), 2)
+        self.assertTrue(TFIDFVectorStore.exists(self.store_dir))
+
+    def test_runs_once_per_interval(self):
+        self.assertTrue(run_maintenance_if_due(interval=3600))
+        self.assertFalse(run_maintenance_if_due(interval=3600))
+        self.assertTrue(run_maintenance_if_due(interval=0))
+
+
+class SearchRoutingTests(DocumentStoreTestCase):
+    NODES = ['node-a', 'node-b']
+    STORE_TEXTS = ["Backup pumps start on loss of pressure.", "Valves are inspected every quarter."]
+
+    def setUp(self):
+        super().setUp()
+        # Two nodes sharing one channel layer; this process plays the node that does not own the store.
+        self.layer = InMemoryChannelLayer()
+        owner = SearchRouter('node-a', self.NODES).owner(self.user.id, self.document.id)
+        self.remote_node = owner
+        self.router = SearchRouter(next(node for node in self.NODES if node != owner), self.NODES,
+                                   timeout=0.2, cooldown=30)
+        self.messages = []
+
+    async def serve_one(self):
+        worker = SearchWorkerConsumer()
+        worker.channel_layer = self.layer
+        message = await self.layer.receive(search_channel_name(self.remote_node))
+        self.messages.append(message)
+        await worker.rag_search(message)
+        await asyncio.gather(*worker.tasks)
+
+    async def search(self, query):
+        consumer = ChatConsumer()
+        consumer.user = self.user
+        consumer.document_id = self.document.id
+        consumer.channel_layer = self.layer
+        with mock.patch('Chat.consumers.get_search_router', return_value=self.router):
+            return await consumer._search(query, debug=True)
+
+    async def test_remote_hit(self):
+        served = asyncio.ensure_future(self.serve_one())
+        results = await self.search("backup pumps")
+        await served
+
+        self.assertEqual(results[0]['content'], "Backup pumps start on loss of pressure.")
+        self.assertTrue(self.messages[0]['debug'])
+        self.assertFalse(self.router.is_local(self.user.id, self.document.id))
+
+    async def test_timeout_falls_back_locally_and_cools_down(self):
+        results = await self.search("backup pumps")
+
+        self.assertEqual(results[0]['content'], "Backup pumps start on loss of pressure.")
+        self.assertTrue(self.router.is_local(self.user.id, self.document.id))
+
+    async def test_remote_search_error_propagates(self):
+        shutil.rmtree(self.store_dir)
+        served = asyncio.ensure_future(self.serve_one())
+
+        with self.assertRaises(RemoteSearchError):
+            await self.search("backup pumps")
+        await served
+        self.assertFalse(self.router.is_local(self.user.id, self.document.id))
+
+
+@profile_hook('test.extract')
+def profiled_extract():
+    return sum(range(1000))
+
+
+@profile_hook('test.chunk')
+def profiled_chunk():
+    return sorted(range(1000), reverse=True)
+
+
+class ProfilingTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        settings_override = override_settings(PROFILING_DIR=self.directory, PROFILING_SAMPLE_RATE=0.0,
+                                              PROFILING_MAX_FILES=200)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def profiles(self):
+        return sorted(path.name.split('-')[2] for path in self.directory.glob('*.prof'))
+
+    def test_only_requested_calls_are_profiled(self):
+        profiled_extract()
+        with profiling_requested(False):
+            profiled_extract()
+        self.assertEqual(self.profiles(), [])
+
+        with profiling_requested(True):
+            profiled_extract()
+        self.assertEqual(self.profiles(), ['test.extract'])
+
+    async def test_request_propagates_through_sync_to_async(self):
+        with profiling_requested(True):
+            await sync_to_async(profiled_extract)()
+            await sync_to_async(profiled_chunk, thread_sensitive=False)()
+
+        self.assertEqual(self.profiles(), ['test.chunk', 'test.extract'])
+
+    def test_sampling_is_decided_once_per_request(self):
+        with override_settings(PROFILING_SAMPLE_RATE=0.5), \
+                mock.patch('Chat.profiling.random.random', side_effect=[0.1, 0.9]) as draw:
+            with profiling_requested(False):
+                profiled_extract()
+                profiled_chunk()
+            with profiling_requested(False):
+                profiled_extract()
+                profiled_chunk()
+
+        self.assertEqual(draw.call_count, 2)
+        self.assertEqual(self.profiles(), ['test.chunk', 'test.extract'])
+
+    def test_old_profiles_are_pruned(self):
+        with override_settings(PROFILING_MAX_FILES=2), profiling_requested(True):
+            for _ in range(4):
+                profiled_extract()
+                time.sleep(0.01)
+            profiled_chunk()
+
+        # The two newest survive: the last extract and the chunk.
+        self.assertEqual(self.profiles(), ['test.chunk', 'test.extract'])
+
+
+class SlowLLM:
+    def __init__(self):
+        self.running = 0
+        self.peak = 0
+
+    def generate_response(self, query, context, memory=None):
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        time.sleep(0.02)
+        self.running -= 1
+        return f"answer to {query}"
+
+
+class BatchQueryTests(DocumentStoreTestCase):
+    STORE_TEXTS = RERANK_PASSAGES
+
+    def setUp(self):
+        super().setUp()
+        self.pending = PDFDocument.objects.create(user=self.user, title='processing', pdf_file='pending.pdf')
+
+    def test_skips_documents_without_a_store_unless_listed(self):
+        results = BatchRAGService(self.user).search(["power supply"], k=1)
+        self.assertEqual(results[0][0]['document_id'], self.document.id)
+
+        with self.assertRaises(Exception):
+            BatchRAGService(self.user, [self.document.id, self.pending.id]).search(["power supply"])
+
+    def test_reranks_like_single_search(self):
+        queries = [item['query'] for item in RERANK_QUERIES]
+        plain = BatchRAGService(self.user).search(queries, k=1, rerank=False)
+        reranked = BatchRAGService(self.user).search(queries, k=1, rerank=True)
+
+        for item, hits in zip(RERANK_QUERIES, reranked):
+            self.assertIn(item['expected'], hits[0]['content'])
+        self.assertNotEqual([hits[0]['content'] for hits in plain], [hits[0]['content'] for hits in reranked])
+
+    def post_batch(self, controller, queries):
+        request = APIRequestFactory().post('/api/v1/batch/', {'queries': queries}, format='json')
+        force_authenticate(request, user=self.user)
+        with mock.patch('Chat.views.get_admission_controller', return_value=controller):
+            return BatchQueryAPI.as_view()(request)
+
+    def test_batches_are_charged_per_query_and_refunded_on_failure(self):
+        controller = AdmissionController(batch_rate=0, batch_burst=10)
+        with mock.patch.object(BatchRAGService, 'search', side_effect=Exception("index unavailable")):
+            response = self.post_batch(controller, ["power supply"] * 6)
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(controller.batch_buckets[self.user.id].tokens, 10)
+
+        with override_settings(GROQ_API_KEY='test'):
+            self.assertEqual(self.post_batch(controller, ["power supply"] * 6).status_code, 200)
+            response = self.post_batch(controller, ["power supply"] * 6)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.data['code'], 4010)
+
+    async def test_stream_yields_answers_within_the_process_wide_cap(self):
+        queries = [f"question {i}" for i in range(6)] + ["question 0"]
+        results = [[{'content': 'context', 'page': 1, 'score': 1.0}]] * len(queries)
+        llm = SlowLLM()
+
+        with mock.patch('Chat.views._llm_slots', asyncio.Semaphore(2)):
+            lines = [json.loads(line) async for line in BatchQueryAPI()._stream(queries, results, llm, 0.0)]
+
+        self.assertLessEqual(llm.peak, 2)
+        self.assertEqual(sorted(line['index'] for line in lines[:-1]), list(range(len(queries))))
+        self.assertEqual(lines[-1]['llm_calls'], 6)
+        answers = {line['index']: line['answer'] for line in lines[:-1]}
+        self.assertEqual(answers[0], answers[6])
+
+
+@unittest.skipUnless(os.path.exists('/proc/self/smaps_rollup'), "needs Linux /proc/self/smaps_rollup")
+class SharedStoreMemoryTests(SimpleTestCase):
+    WORKERS = 8
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = tempfile.TemporaryDirectory()
+        rng = random.Random(0)
+        vocabulary = [f"term{i}" for i in range(3000)]
+        texts = [" ".join(rng.choices(vocabulary, k=80)) for _ in range(8000)]
+        store = TFIDFVectorStore(persist_directory=cls.directory.name, load_existing=False)
+        store.add_texts(texts)
+        store.persist()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+    def test_workers_share_one_copy_of_the_store(self):
+        private = sum(item['Pss'] for item in measure(self.directory.name, 1, copy=True))
+        shared = sum(item['Pss'] for item in measure(self.directory.name, self.WORKERS, copy=False))
+
+        # Eight private copies would cost 8x; mapped pages are split between the workers.
+        self.assertLess(shared, self.WORKERS * private / 3, f"shared={shared}KiB private={private}KiB")
@@ -4,5 +4,6 @@ from . import views
 
 urlpatterns = [
     path('documents/', views.PDFUploadAPI.as_view(), name='api_upload'),
+    path('batch/', views.BatchQueryAPI.as_view(), name='api_batch_query'),
 
 ]
\ No newline at end of file
@@ -1,53 +1,219 @@
 import os
 import logging
+import mmap
 import pickle
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
 from pathlib import Path
 from django.conf import settings
 from langchain_community.document_loaders import PyPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_groq import ChatGroq
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 import numpy as np
+from scipy import sparse
+from .chunking import split_documents
 from .models import PDFDocument, DocumentChunk
+from .profiling import profile_hook
 
 
 
 logger = logging.getLogger(__name__)
 
+NO_CONTEXT_RESPONSE = "I couldn't find relevant information in your documents."
+
+
+def format_context(results):
+    return [f"[Page {res['page']}] {res['content']}" if res.get('page') else f"Result {res['content']}"
+            for res in results]
+
+
+class Document:
+    def __init__(self, content, metadata=None):
+        self.page_content = content
+        self.metadata = metadata or {}
+
+
+class ChunkStore:
+    """Chunk texts stored as one UTF-8 blob plus an offsets array.
+
+    On load both files are memory-mapped, so a store keeps no Python object
+    per chunk and only the passages that are actually read get decoded.
+    """
+
+    BLOB_FILE = 'chunks.bin'
+    OFFSETS_FILE = 'offsets.npy'
+
+    def __init__(self, blob=b'', offsets=None):
+        self._blob = blob
+        self._offsets = offsets if offsets is not None else np.zeros(1, dtype=np.int64)
+
+    @classmethod
+    def from_texts(cls, texts):
+        encoded = [text.encode('utf-8') for text in texts]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        if encoded:
+            np.cumsum([len(chunk) for chunk in encoded], out=offsets[1:])
+        return cls(b''.join(encoded), offsets)
+
+    @classmethod
+    def exists(cls, directory):
+        return (Path(directory) / cls.OFFSETS_FILE).exists()
+
+    @classmethod
+    def open(cls, directory):
+        directory = Path(directory)
+        offsets = np.load(directory / cls.OFFSETS_FILE, mmap_mode='r')
+
+        blob = b''
+        if (directory / cls.BLOB_FILE).stat().st_size:
+            with open(directory / cls.BLOB_FILE, 'rb') as f:
+                blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return cls(blob, offsets)
+
+    def save(self, directory):
+        directory = Path(directory)
+        with open(directory / self.BLOB_FILE, 'wb') as f:
+            f.write(self._blob)
+        np.save(directory / self.OFFSETS_FILE, np.asarray(self._offsets))
+
+    @property
+    def nbytes(self):
+        return len(self._blob) + self._offsets.nbytes
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        index = int(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("chunk index out of range")
+
+        start, end = int(self._offsets[index]), int(self._offsets[index + 1])
+        return self._blob[start:end].decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def touch(self):
+        if len(self._blob):
+            np.frombuffer(self._blob, dtype=np.uint8)[::mmap.PAGESIZE].sum()
+        np.asarray(self._offsets).sum()
+
 
 class TFIDFVectorStore:
+    VECTOR_FILES = ('vectors_data.npy', 'vectors_indices.npy', 'vectors_indptr.npy')
+    PAGES_FILE = 'pages.npy'
+    CURRENT_FILE = 'CURRENT'
+    VERSION_PREFIX = 'v-'
+    STAGING_PREFIX = '.tmp-'
+    LOAD_ATTEMPTS = 3
+
     def __init__(self, persist_directory=None, load_existing=True):
         self.persist_directory = persist_directory
         self.vectorizer = TfidfVectorizer(max_features=1000, stop_words='english')
-        self.documents = []
+        self.documents = ChunkStore()
+        self.pages = None
         self.vectors = None
+        self._analyzer = None
+        self._warm = False
 
-        if load_existing and persist_directory and Path(persist_directory).exists():
-            vectorizer_path = Path(persist_directory) / 'vectorizer.pkl'
-            if vectorizer_path.exists():
-                self.load()
+        if load_existing and persist_directory and self.exists(persist_directory):
+            self.load()
 
-    def add_texts(self, texts):
-        self.documents = texts
+    @classmethod
+    def data_path(cls, directory):
+        """Directory holding the live files: the version named by CURRENT, or the store itself for flat stores."""
+        directory = Path(directory)
+        try:
+            return directory / (directory / cls.CURRENT_FILE).read_text().strip()
+        except FileNotFoundError:
+            return directory
+
+    @classmethod
+    def exists(cls, directory):
+        return (cls.data_path(directory) / 'vectorizer.pkl').exists()
+
+    def add_texts(self, texts, metadatas=None):
+        self.documents = ChunkStore.from_texts(texts)
+        if metadatas:
+            # 0 marks a chunk whose page is unknown; page numbers are 1-based.
+            self.pages = np.array([metadata.get('page') or 0 for metadata in metadatas], dtype=np.int32)
         self.vectors = self.vectorizer.fit_transform(texts)
         return self
 
+    @property
+    def analyzer(self):
+        if self._analyzer is None:
+            self._analyzer = self.vectorizer.build_analyzer()
+        return self._analyzer
+
+    def warm_up(self):
+        """Fault the memory-mapped payload into memory and run a throwaway query,
+        so the first real search costs the same as any later one."""
+        if self._warm or not len(self.documents):
+            return
+
+        page = mmap.PAGESIZE
+        for array in (self.vectors.data, self.vectors.indices, self.vectors.indptr):
+            np.asarray(array)[::max(1, page // array.itemsize)].sum()
+        self.documents.touch()
+
+        self.analyzer('warm up')
+        self.similarity_search_with_score('warm up', k=1)
+        self._warm = True
+
     def similarity_search(self, query, k=4):
-        if not self.documents:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k)]
+
+    def similarity_search_with_score(self, query, k=4):
+        if not len(self.documents):
             return []
 
+        # TF-IDF rows are L2-normalised, so the dot product is the cosine similarity
+        # and the memory-mapped matrix is never copied.
         query_vector = self.vectorizer.transform([query])
-        similarities = cosine_similarity(query_vector, self.vectors)[0]
+        similarities = (query_vector @ self.vectors.T).toarray()[0]
 
         top_indices = np.argsort(similarities)[-k:][::-1]
 
-        class Document:
-            def __init__(self, content):
-                self.page_content = content
-
-        return [Document(self.documents[i]) for i in top_indices]
+        return [(self.get_document(i), float(similarities[i])) for i in top_indices]
+
+    def batch_similarity_search_with_score(self, queries, k=4, block_size=256):
+        """Top-k chunk indices and scores for many queries with one sparse product per block.
+
+        TF-IDF rows are L2-normalised, so the dot product is the cosine similarity.
+        """
+        if not len(self.documents) or not queries:
+            return [[] for _ in queries]
+
+        query_vectors = self.vectorizer.transform(queries)
+        k = min(k, len(self.documents))
+        results = []
+        for start in range(0, len(queries), block_size):
+            scores = (query_vectors[start:start + block_size] @ self.vectors.T).toarray()
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            for row, indices in zip(scores, top):
+                ranked = indices[np.argsort(-row[indices])]
+                results.append([(int(i), float(row[i])) for i in ranked])
+        return results
+
+    def get_document(self, index):
+        metadata = {}
+        if self.pages is not None and self.pages[index]:
+            metadata['page'] = int(self.pages[index])
+        return Document(self.documents[index], metadata)
 
     def persist(self):
         if not self.persist_directory:
@@ -56,37 +222,287 @@ class TFIDFVectorStore:
         persist_path = Path(self.persist_directory)
         persist_path.mkdir(parents=True, exist_ok=True)
 
-        with open(persist_path / 'vectorizer.pkl', 'wb') as f:
-            pickle.dump(self.vectorizer, f)
+        # Every save is a new immutable version directory. Switching the CURRENT
+        # pointer with os.replace publishes it in one step; a reader that resolved
+        # the previous version either has its files open already or retries.
+        version = f"{self.VERSION_PREFIX}{uuid.uuid4().hex}"
+        staging_path = persist_path / f"{self.STAGING_PREFIX}{version}"
+        pointer_path = persist_path / f"{self.STAGING_PREFIX}{self.CURRENT_FILE}-{version}"
+        staging_path.mkdir()
+
+        try:
+            with open(staging_path / 'vectorizer.pkl', 'wb') as f:
+                pickle.dump(self.vectorizer, f)
+
+            self.documents.save(staging_path)
+            if self.pages is not None:
+                np.save(staging_path / self.PAGES_FILE, self.pages)
+
+            if self.vectors is not None:
+                vectors = self.vectors.tocsr()
+                for name, array in zip(self.VECTOR_FILES, (vectors.data, vectors.indices, vectors.indptr)):
+                    np.save(staging_path / name, array)
+
+            os.rename(staging_path, persist_path / version)
+            pointer_path.write_text(version)
+            os.replace(pointer_path, persist_path / self.CURRENT_FILE)
+        except Exception:
+            shutil.rmtree(staging_path, ignore_errors=True)
+            pointer_path.unlink(missing_ok=True)
+            raise
 
-        with open(persist_path / 'documents.pkl', 'wb') as f:
-            pickle.dump(self.documents, f)
+        self._remove_superseded(persist_path, version)
+        logger.info(f"Vector store saved to {persist_path / version}")
 
-        logger.info(f"Vector store saved to {persist_path}")
+    def _remove_superseded(self, persist_path, version):
+        for path in persist_path.iterdir():
+            # Staging entries may belong to a concurrent save; maintenance clears stale ones.
+            if path.name in (self.CURRENT_FILE, version) or path.name.startswith(self.STAGING_PREFIX):
+                continue
+            if path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                path.unlink(missing_ok=True)
 
     def load(self):
         persist_path = Path(self.persist_directory)
 
         try:
-            with open(persist_path / 'vectorizer.pkl', 'rb') as f:
-                self.vectorizer = pickle.load(f)
-
-            with open(persist_path / 'documents.pkl', 'rb') as f:
-                self.documents = pickle.load(f)
-
-            if self.documents:
-                self.vectors = self.vectorizer.transform(self.documents)
-
-            logger.info(f"Vector store loaded from {persist_path}")
+            for attempt in range(1, self.LOAD_ATTEMPTS + 1):
+                data_path = self.data_path(persist_path)
+                try:
+                    self._load_files(data_path)
+                    break
+                except FileNotFoundError:
+                    # A save retired this version between reading CURRENT and opening its files.
+                    if attempt == self.LOAD_ATTEMPTS or self.data_path(persist_path) == data_path:
+                        raise
+
+            logger.info(f"Vector store loaded from {data_path}")
         except Exception as e:
             logger.error(f"Failed to load vector store: {str(e)}")
             raise
 
+    def _load_files(self, data_path):
+        self.pages = None
+        self.vectors = None
+
+        with open(data_path / 'vectorizer.pkl', 'rb') as f:
+            self.vectorizer = pickle.load(f)
+
+        if ChunkStore.exists(data_path):
+            self.documents = ChunkStore.open(data_path)
+            self.vectors = self._load_vectors(data_path)
+            if (data_path / self.PAGES_FILE).exists():
+                self.pages = np.load(data_path / self.PAGES_FILE, mmap_mode='r')
+        else:
+            # Stores written before the blob format only have the pickled chunk list.
+            with open(data_path / 'documents.pkl', 'rb') as f:
+                self.documents = ChunkStore.from_texts(pickle.load(f))
+
+        if self.vectors is None and len(self.documents):
+            self.vectors = self.vectorizer.transform(list(self.documents))
+
+    @property
+    def nbytes(self):
+        size = self.documents.nbytes
+        if self.vectors is not None:
+            size += self.vectors.data.nbytes + self.vectors.indices.nbytes + self.vectors.indptr.nbytes
+        return size
+
+    def _load_vectors(self, persist_path):
+        if not all((persist_path / name).exists() for name in self.VECTOR_FILES):
+            return None
+
+        data, indices, indptr = (np.load(persist_path / name, mmap_mode='r') for name in self.VECTOR_FILES)
+        shape = (len(indptr) - 1, len(self.vectorizer.vocabulary_))
+        return sparse.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+
+class ProximityReranker:
+    """Second-pass scorer for TF-IDF candidates: term coverage, phrase matches and proximity."""
+
+    def __init__(self, analyzer, weight=0.5, batch_size=8):
+        self.analyzer = analyzer
+        self.weight = weight
+        self.batch_size = batch_size
+
+    def rerank(self, query, candidates, budget_ms):
+        query_tokens = self.analyzer(query)
+        if not candidates or not query_tokens or budget_ms <= 0:
+            return candidates
+
+        term_ids = {}
+        for token in query_tokens:
+            term_ids.setdefault(token, len(term_ids))
+        query_ids = np.array([term_ids[token] for token in query_tokens])
+        bigrams = np.unique(query_ids[:-1] * len(term_ids) + query_ids[1:])
+
+        deadline = time.perf_counter() + budget_ms / 1000
+        scored = []
+        for start in range(0, len(candidates), self.batch_size):
+            if time.perf_counter() >= deadline:
+                break
+
+            batch = candidates[start:start + self.batch_size]
+            scores = self._score_batch([doc.page_content for doc, _ in batch], term_ids, bigrams)
+            first_stage = np.array([score for _, score in batch])
+            combined = (1 - self.weight) * first_stage + self.weight * scores
+            scored.extend((doc, float(score)) for (doc, _), score in zip(batch, combined))
+
+        scored.sort(key=lambda item: item[1], reverse=True)
+        return scored + candidates[len(scored):]
+
+    def _score_batch(self, texts, term_ids, bigrams):
+        n_terms = len(term_ids)
+        token_ids = [np.array([term_ids.get(token, -1) for token in self.analyzer(text)], dtype=np.int64)
+                     for text in texts]
+        lengths = np.array([len(ids) for ids in token_ids])
+        ids = np.concatenate(token_ids) if lengths.sum() else np.zeros(0, dtype=np.int64)
+        doc_index = np.repeat(np.arange(len(texts)), lengths)
+
+        matched = ids >= 0
+        distinct = np.unique(doc_index[matched] * n_terms + ids[matched])
+        coverage = np.bincount(distinct // n_terms, minlength=len(texts)) / n_terms
+
+        phrase = np.zeros(len(texts))
+        if bigrams.size and ids.size > 1:
+            same_doc = (doc_index[:-1] == doc_index[1:]) & matched[:-1] & matched[1:]
+            pairs = ids[:-1] * n_terms + ids[1:]
+            hits = same_doc & np.isin(pairs, bigrams)
+            phrase = np.minimum(np.bincount(doc_index[:-1][hits], minlength=len(texts)) / bigrams.size, 1.0)
+
+        proximity = np.array([self._proximity(doc_ids) for doc_ids in token_ids])
+
+        return 0.5 * coverage + 0.3 * phrase + 0.2 * proximity
+
+    @staticmethod
+    def _proximity(ids):
+        """Distinct matched terms divided by the shortest window containing all of them."""
+        positions = np.flatnonzero(ids >= 0)
+        if positions.size == 0:
+            return 0.0
+
+        needed = len(set(ids[positions].tolist()))
+        counts = {}
+        best = None
+        left = 0
+        for right in range(positions.size):
+            term = ids[positions[right]]
+            counts[term] = counts.get(term, 0) + 1
+            while len(counts) == needed:
+                window = positions[right] - positions[left] + 1
+                best = window if best is None else min(best, window)
+                left_term = ids[positions[left]]
+                counts[left_term] -= 1
+                if not counts[left_term]:
+                    del counts[left_term]
+                left += 1
+
+        return needed / best
+
+
+def vector_store_path(user_id, document_id):
+    return Path(settings.MEDIA_ROOT) / 'vector_stores' / str(user_id) / str(document_id)
+
+
+class StoreRegistry:
+    """Reference-counted LRU cache of memory-mapped vector stores, keyed by (user, document)."""
+
+    def __init__(self, capacity=32):
+        self.capacity = capacity
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _version(path):
+        for attempt in range(1, TFIDFVectorStore.LOAD_ATTEMPTS + 1):
+            data_path = TFIDFVectorStore.data_path(path)
+            try:
+                return data_path.name, (data_path / 'vectorizer.pkl').stat().st_mtime_ns
+            except FileNotFoundError:
+                # Same race as TFIDFVectorStore.load: a save retired the version CURRENT named.
+                if attempt == TFIDFVectorStore.LOAD_ATTEMPTS or TFIDFVectorStore.data_path(path) == data_path:
+                    raise
+
+    def acquire(self, user_id, document_id):
+        key = (str(user_id), str(document_id))
+        path = vector_store_path(user_id, document_id)
+        version = self._version(path)
+
+        with self._lock:
+            store = self._reuse(key, version)
+            if store is not None:
+                return store
+
+        store = TFIDFVectorStore(persist_directory=str(path), load_existing=True)
+
+        with self._lock:
+            existing = self._reuse(key, version)
+            if existing is not None:
+                return existing
+            # A stale entry is simply replaced; its holders keep their own reference.
+            self._entries[key] = {'store': store, 'version': version, 'refs': 1}
+            self._entries.move_to_end(key)
+            self._evict()
+
+        return store
+
+    def _reuse(self, key, version):
+        entry = self._entries.get(key)
+        if entry is None or entry['version'] != version:
+            return None
+        entry['refs'] += 1
+        self._entries.move_to_end(key)
+        return entry['store']
+
+    def release(self, user_id, document_id, store):
+        with self._lock:
+            entry = self._entries.get((str(user_id), str(document_id)))
+            if entry is not None and entry['store'] is store:
+                entry['refs'] -= 1
+                self._evict()
+
+    @contextmanager
+    def attach(self, user_id, document_id):
+        store = self.acquire(user_id, document_id)
+        try:
+            yield store
+        finally:
+            self.release(user_id, document_id, store)
+
+    def warm(self, user_id, document_id):
+        with self.attach(user_id, document_id) as store:
+            store.warm_up()
+
+    def discard(self, user_id, document_id):
+        with self._lock:
+            self._entries.pop((str(user_id), str(document_id)), None)
+
+    def _evict(self):
+        for key in list(self._entries):
+            if len(self._entries) <= self.capacity:
+                break
+            if self._entries[key]['refs'] <= 0:
+                del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'stores': len(self._entries),
+                'in_use': sum(1 for entry in self._entries.values() if entry['refs'] > 0),
+                'mapped_bytes': sum(entry['store'].nbytes for entry in self._entries.values()),
+            }
+
+
+store_registry = StoreRegistry(capacity=getattr(settings, 'VECTOR_STORE_CACHE_SIZE', 32))
+
 
 class PDFProcessor:
     def __init__(self, document):
         self.document = document
 
+    @profile_hook('ingest.extract_text')
     def extract_text(self):
         try:
             loader = PyPDFLoader(self.document.pdf_file.path)
@@ -101,40 +517,49 @@ class PDFProcessor:
             logger.error(f"PDF extraction failed for {self.document.id}: {str(e)}")
             raise Exception(f"Failed to extract text from PDF: {str(e)}")
 
-    def chunk_text(self, pages, chunk_size=1000, chunk_overlap=200):
+    @profile_hook('ingest.chunk_text')
+    def chunk_text(self, pages, strategy=None, chunk_size=None, chunk_overlap=None):
         try:
-            text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=chunk_size,
-                chunk_overlap=chunk_overlap,
-                length_function=len,
-                separators=["\n\n", "\n", " ", ""]
+            chunks = split_documents(
+                pages,
+                strategy=strategy or getattr(settings, 'CHUNK_STRATEGY', 'recursive'),
+                chunk_size=chunk_size or getattr(settings, 'CHUNK_SIZE', 1000),
+                chunk_overlap=chunk_overlap if chunk_overlap is not None else getattr(settings, 'CHUNK_OVERLAP', 200),
             )
 
-            chunks = text_splitter.split_documents(pages)
-
-            for i, chunk in enumerate(chunks):
-                DocumentChunk.objects.create(
+            DocumentChunk.objects.bulk_create([
+                DocumentChunk(
                     document=self.document,
                     text=chunk.page_content,
+                    page=chunk.metadata.get('page'),
                 )
+                for chunk in chunks
+            ])
 
-            return [chunk.page_content for chunk in chunks]
+            return chunks
 
         except Exception as e:
             logger.error(f"Text chunking failed: {str(e)}")
             raise Exception(f"Failed to chunk text: {str(e)}")
 
+    @profile_hook('ingest.create_vector_store')
     def create_vector_store(self, chunks):
         try:
-            vector_dir = Path(settings.MEDIA_ROOT) / 'vector_stores' / str(self.document.user.id) / str(
-                self.document.id)
-            vector_dir.mkdir(parents=True, exist_ok=True)
+            vector_dir = vector_store_path(self.document.user.id, self.document.id)
 
             vectordb = TFIDFVectorStore(persist_directory=str(vector_dir), load_existing=False)
-            vectordb.add_texts(chunks)
+            vectordb.add_texts(
+                [chunk.page_content for chunk in chunks],
+                [chunk.metadata for chunk in chunks],
+            )
             vectordb.persist()
 
             logger.info(f"Vector store created for document {self.document.id}")
+
+            try:
+                store_registry.warm(self.document.user.id, self.document.id)
+            except Exception as e:
+                logger.warning(f"Vector store warm-up failed for document {self.document.id}: {str(e)}")
             return True
 
         except Exception as e:
@@ -146,26 +571,26 @@ class RAGService:
     def __init__(self, user, document_id=None):
         self.user = user
         self.document_id = document_id
+        self.last_timings = {}
 
-    def get_vector_store(self):
+    def _locate_vector_store(self):
         try:
             if self.document_id:
-                document = PDFDocument.objects.get(id=self.document_id, user=self.user)
-                vector_path = Path(settings.MEDIA_ROOT) / 'vector_stores' / str(self.user.id) / str(document.id)
+                document_id = PDFDocument.objects.get(id=self.document_id, user=self.user).id
             else:
-                vector_path = Path(settings.MEDIA_ROOT) / 'vector_stores' / str(self.user.id)
                 first_doc = PDFDocument.objects.filter(user=self.user).first()
-                if first_doc:
-                    vector_path = vector_path / str(first_doc.id)
+                if not first_doc:
+                    raise Exception("Vector store not found. Please upload and process the document first.")
+                document_id = first_doc.id
 
+            vector_path = vector_store_path(self.user.id, document_id)
             if not vector_path.exists():
                 raise Exception("Vector store not found. Please upload and process the document first.")
 
-            vectorizer_path = vector_path / 'vectorizer.pkl'
-            if not vectorizer_path.exists():
+            if not TFIDFVectorStore.exists(vector_path):
                 raise Exception("Vector store files not found. Please re-process the document.")
 
-            return TFIDFVectorStore(persist_directory=str(vector_path), load_existing=True)
+            return document_id
 
         except PDFDocument.DoesNotExist:
             raise Exception("Document not found or access denied")
@@ -173,17 +598,72 @@ class RAGService:
             logger.error(f"Failed to load vector store: {str(e)}")
             raise Exception(f"Failed to load vector store: {str(e)}")
 
-    def search(self, query, k=4):
-        """Search for relevant chunks"""
+    @contextmanager
+    def open_vector_store(self):
+        """Attach to the shared store for the duration of the block"""
+        document_id = self._locate_vector_store()
+
+        try:
+            vectordb = store_registry.acquire(self.user.id, document_id)
+        except Exception as e:
+            logger.error(f"Failed to load vector store: {str(e)}")
+            raise Exception(f"Failed to load vector store: {str(e)}")
+
+        try:
+            yield vectordb
+        finally:
+            store_registry.release(self.user.id, document_id, vectordb)
+
+    def get_vector_store(self):
+        with self.open_vector_store() as vectordb:
+            return vectordb
+
+    def pin_vector_store(self):
+        """Load, warm and hold the store until the returned release callback is called"""
+        document_id = self._locate_vector_store()
+        vectordb = store_registry.acquire(self.user.id, document_id)
+        try:
+            vectordb.warm_up()
+        except Exception:
+            store_registry.release(self.user.id, document_id, vectordb)
+            raise
+        return lambda: store_registry.release(self.user.id, document_id, vectordb)
+
+    @profile_hook('rag.search')
+    def search(self, query, k=4, rerank=True):
+        """Search for relevant chunks: cheap TF-IDF top-N, then a bounded re-rank"""
         try:
-            vectordb = self.get_vector_store()
-            results = vectordb.similarity_search(query, k=k)
+            timings = {}
+            started = time.perf_counter()
+            with self.open_vector_store() as vectordb:
+                timings['load_ms'] = (time.perf_counter() - started) * 1000
+
+                candidate_k = max(k, getattr(settings, 'RAG_CANDIDATE_K', 20)) if rerank else k
+                started = time.perf_counter()
+                results = vectordb.similarity_search_with_score(query, k=candidate_k)
+                timings['retrieve_ms'] = (time.perf_counter() - started) * 1000
+
+                if rerank:
+                    started = time.perf_counter()
+                    reranker = ProximityReranker(
+                        vectordb.analyzer,
+                        weight=getattr(settings, 'RAG_RERANK_WEIGHT', 0.5),
+                        batch_size=getattr(settings, 'RAG_RERANK_BATCH_SIZE', 8),
+                    )
+                    results = reranker.rerank(query, results, getattr(settings, 'RAG_RERANK_BUDGET_MS', 30))
+                    timings['rerank_ms'] = (time.perf_counter() - started) * 1000
+
+            self.last_timings = timings
+            logger.info(f"Search timings for user {self.user.id}: " +
+                        ", ".join(f"{stage}={ms:.1f}" for stage, ms in timings.items()))
 
             return [
                 {
                     'content': doc.page_content,
+                    'page': doc.metadata.get('page'),
+                    'score': score,
                 }
-                for doc in results
+                for doc, score in results[:k]
             ]
 
         except Exception as e:
@@ -191,6 +671,79 @@ class RAGService:
             raise Exception(f"Search failed: {str(e)}")
 
 
+class BatchRAGService:
+    """Retrieval for many queries at once, one sparse product per document store."""
+
+    def __init__(self, user, document_ids=None):
+        self.user = user
+        self.document_ids = document_ids
+
+    def get_documents(self):
+        documents = PDFDocument.objects.filter(user=self.user)
+        if self.document_ids:
+            documents = documents.filter(id__in=self.document_ids)
+            if documents.count() != len(set(self.document_ids)):
+                raise Exception("Document not found or access denied")
+        return list(documents)
+
+    def search(self, queries, k=4, rerank=True):
+        try:
+            unique_queries = list(dict.fromkeys(queries))
+            merged = {query: [] for query in unique_queries}
+            passages = {}
+            candidate_k = max(k, getattr(settings, 'RAG_CANDIDATE_K', 20)) if rerank else k
+
+            for document in self.get_documents():
+                if not TFIDFVectorStore.exists(vector_store_path(self.user.id, document.id)):
+                    if self.document_ids:
+                        raise Exception(f"Vector store not found for document {document.id}")
+                    # Still processing (or failed); only documents asked for by id must be searchable.
+                    logger.info(f"Batch search skipping document {document.id} without a vector store")
+                    continue
+
+                with store_registry.attach(self.user.id, document.id) as vectordb:
+                    hits = vectordb.batch_similarity_search_with_score(unique_queries, k=candidate_k)
+                    reranker = ProximityReranker(
+                        vectordb.analyzer,
+                        weight=getattr(settings, 'RAG_RERANK_WEIGHT', 0.5),
+                        batch_size=getattr(settings, 'RAG_RERANK_BATCH_SIZE', 8),
+                    ) if rerank else None
+                    # Chunks are decoded once per document; the reranker hands back the same objects.
+                    chunks = {}
+                    positions = {}
+
+                    for query, query_hits in zip(unique_queries, hits):
+                        candidates = []
+                        for index, score in query_hits:
+                            if index not in chunks:
+                                chunks[index] = vectordb.get_document(index)
+                                positions[id(chunks[index])] = index
+                            candidates.append((chunks[index], score))
+                        if reranker is not None:
+                            candidates = reranker.rerank(query, candidates, getattr(settings, 'RAG_RERANK_BUDGET_MS', 30))
+
+                        for doc, score in candidates[:k]:
+                            key = (document.id, positions[id(doc)])
+                            if key not in passages:
+                                passages[key] = {
+                                    'document_id': document.id,
+                                    'content': doc.page_content,
+                                    'page': doc.metadata.get('page'),
+                                }
+                            merged[query].append((score, key))
+
+            results = {}
+            for query, candidates in merged.items():
+                candidates.sort(key=lambda item: item[0], reverse=True)
+                results[query] = [{**passages[key], 'score': score} for score, key in candidates[:k]]
+
+            return [results[query] for query in queries]
+
+        except Exception as e:
+            logger.error(f"Batch search failed: {str(e)}")
+            raise Exception(f"Batch search failed: {str(e)}")
+
+
 class LLMService:
 
     def __init__(self, model_name=None):
@@ -199,13 +752,16 @@ class LLMService:
 
         self.model_name = model_name or getattr(settings, 'GROQ_MODEL', 'llama-3.3-70b-versatile')
 
-    def generate_response(self, query, context):
+    def _get_llm(self, temperature=0.7):
+        return ChatGroq(
+            model=self.model_name,
+            temperature=temperature,
+            groq_api_key=settings.GROQ_API_KEY,
+        )
+
+    def generate_response(self, query, context, memory=None):
         try:
-            llm = ChatGroq(
-                model=self.model_name,
-                temperature=0.7,
-                groq_api_key=settings.GROQ_API_KEY,
-            )
+            llm = self._get_llm()
 
             system_prompt = """You are a helpful assistant that answers questions based on the provided context.
                   Context comes from user-uploaded PDF documents.
@@ -223,9 +779,16 @@ class LLMService:
                   {context}"""
 
             messages = [
-                system_prompt.format(context="\n\n".join(context)),
+                SystemMessage(content=system_prompt.format(context="\n\n".join(context))),
             ]
 
+            if memory is not None:
+                if memory.summary:
+                    messages.append(SystemMessage(content=f"Summary of earlier conversation: {memory.summary}"))
+                for question, answer in memory.history():
+                    messages.append(HumanMessage(content=question))
+                    messages.append(AIMessage(content=answer))
+
             messages.append(HumanMessage(content=query))
 
             response = llm.invoke(messages)
@@ -235,4 +798,44 @@ class LLMService:
         except Exception as e:
             error_msg = str(e)
             logger.error(f"LLM generation failed: {error_msg}")
-            raise Exception(f"Failed to generate response: {error_msg}")
\ No newline at end of file
+            raise Exception(f"Failed to generate response: {error_msg}")
+
+    def rewrite_query(self, query, memory):
+        """Rewrite a follow-up question into a standalone one for retrieval"""
+        try:
+            llm = self._get_llm(temperature=0)
+
+            messages = [
+                SystemMessage(content="Rewrite the user's latest question as a standalone question that can be "
+                                      "understood without the conversation. Resolve pronouns and references. "
+                                      "Return only the rewritten question."),
+                HumanMessage(content=f"Conversation:\n{memory.format_history()}\n\nLatest question: {query}"),
+            ]
+
+            rewritten = llm.invoke(messages).content.strip()
+            return rewritten or query
+
+        except Exception as e:
+            error_msg = str(e)
+            logger.error(f"Query rewrite failed: {error_msg}")
+            raise Exception(f"Failed to rewrite query: {error_msg}")
+
+    def summarize(self, summary, turns):
+        """Fold evicted turns into the rolling conversation summary"""
+        try:
+            llm = self._get_llm(temperature=0)
+
+            transcript = "\n".join(f"User: {question}\nAssistant: {answer}" for question, answer in turns)
+            messages = [
+                SystemMessage(content="Update the running summary of a conversation with the new exchanges. "
+                                      "Keep the facts, names and open questions the user may refer back to. "
+                                      "Answer with the summary only, in at most 150 words."),
+                HumanMessage(content=f"Current summary:\n{summary or '(empty)'}\n\nNew exchanges:\n{transcript}"),
+            ]
+
+            return llm.invoke(messages).content
+
+        except Exception as e:
+            error_msg = str(e)
+            logger.error(f"Conversation summary failed: {error_msg}")
+            raise Exception(f"Failed to summarize conversation: {error_msg}")
@@ -1,18 +1,38 @@
 from django.shortcuts import render
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from asgiref.sync import sync_to_async
+import asyncio
+import json
 import logging
+import math
+import time
 from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
-from .serializers import PDFUploadedSerializer,PDFDocumentSerializer
+from .serializers import PDFUploadedSerializer,PDFDocumentSerializer,BatchQuerySerializer
 from .models import PDFDocument
 from rest_framework import status
 from rest_framework.response import Response
-from .utils import PDFProcessor
+from .admission import AdmissionRejected, get_admission_controller
+from .profiling import profiling_requested
+from .utils import PDFProcessor, BatchRAGService, LLMService, NO_CONTEXT_RESPONSE, format_context
 import threading
 
 # Create your views here.
 
 logger = logging.getLogger(__name__)
 
+_llm_slots = None
+
+
+def get_llm_slots():
+    """Process-wide cap on concurrent batch LLM calls, shared by every request."""
+    global _llm_slots
+    if _llm_slots is None:
+        _llm_slots = asyncio.Semaphore(getattr(settings, 'BATCH_LLM_CONCURRENCY', 4))
+    return _llm_slots
+
+
 class PDFUploadAPI(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -35,7 +55,9 @@ class PDFUploadAPI(APIView):
                 title=title,
                 pdf_file=pdf_file
             )
-            self._process_in_background(document)
+            # Staff can ask for ingestion profiles with debug=true.
+            profile = serializer.validated_data.get('debug') and request.user.is_staff
+            self._process_in_background(document, profile)
             return Response({
                 'success': True,
                 'message': 'PDF uploaded successfully. Processing started.',
@@ -56,14 +78,15 @@ class PDFUploadAPI(APIView):
             'success': True,
             'documents': serializer.data
         })
-    def _process_in_background(self,document):
+    def _process_in_background(self,document,profile=False):
 
         def process():
             try:
                 processor=PDFProcessor(document)
-                pages = processor.extract_text()
-                chunks = processor.chunk_text(pages)
-                processor.create_vector_store(chunks)
+                with profiling_requested(profile):
+                    pages = processor.extract_text()
+                    chunks = processor.chunk_text(pages)
+                    processor.create_vector_store(chunks)
 
 
                 document.save()
@@ -78,9 +101,110 @@ class PDFUploadAPI(APIView):
         thread.start()
 
 
+class BatchQueryAPI(APIView):
+    """Answer many questions against a set of documents, streamed back as NDJSON"""
+    permission_classes = [IsAuthenticated]
 
+    def post(self, request):
+        serializer = BatchQuerySerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response({
+                'success': False,
+                'error': 'validation failed',
+                'detail': serializer.errors
+            }, status=status.HTTP_400_BAD_REQUEST)
 
+        data = serializer.validated_data
+        controller = get_admission_controller()
+        try:
+            controller.charge_batch(request.user.id, len(data['queries']))
+        except AdmissionRejected as e:
+            response = Response({
+                'success': False,
+                'error': str(e),
+                'code': e.code,
+                'retry_after': e.retry_after
+            }, status=status.HTTP_429_TOO_MANY_REQUESTS)
+            response['Retry-After'] = str(math.ceil(e.retry_after))
+            return response
 
+        try:
+            started = time.perf_counter()
+            results = BatchRAGService(request.user, data.get('document_ids')).search(
+                data['queries'], k=data['k'], rerank=data['rerank'])
+            search_ms = (time.perf_counter() - started) * 1000
+            llm_service = LLMService() if data['generate'] else None
+        except Exception as e:
+            logger.error(f"Batch query failed: {str(e)}")
+            controller.refund_batch(request.user.id, len(data['queries']))
+            return Response({
+                'success': False,
+                'error': 'Batch query failed',
+                'message': str(e)
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-
-
+        return StreamingHttpResponse(
+            self._stream(data['queries'], results, llm_service, search_ms),
+            content_type='application/x-ndjson',
+        )
+
+    async def _stream(self, queries, results, llm_service, search_ms):
+        started = time.perf_counter()
+
+        # Identical questions over identical contexts share one LLM call.
+        groups = {}
+        for index, (query, contexts) in enumerate(zip(queries, results)):
+            groups.setdefault((query, tuple(format_context(contexts))), []).append(index)
+
+        def line(index, answer=None, error=None):
+            payload = {'type': 'result', 'index': index, 'query': queries[index], 'contexts': results[index]}
+            if llm_service is not None:
+                payload.update({'answer': answer, 'error': error})
+            return json.dumps(payload) + "\n"
+
+        llm_calls = 0
+        if llm_service is None:
+            for index in range(len(queries)):
+                yield line(index)
+        else:
+            generate = sync_to_async(llm_service.generate_response, thread_sensitive=False)
+            slots = get_llm_slots()
+
+            async def answer(query, context_texts, indices):
+                async with slots:
+                    call = asyncio.ensure_future(generate(query, list(context_texts)))
+                    try:
+                        return indices, await asyncio.shield(call), None
+                    except asyncio.CancelledError:
+                        # The thread can't be stopped; hold its slot until it returns.
+                        await asyncio.wait([call])
+                        raise
+                    except Exception as e:
+                        return indices, None, str(e)
+
+            tasks = []
+            try:
+                for (query, context_texts), indices in groups.items():
+                    if not context_texts:
+                        for index in indices:
+                            yield line(index, answer=NO_CONTEXT_RESPONSE)
+                        continue
+                    tasks.append(asyncio.ensure_future(answer(query, context_texts, indices)))
+                llm_calls = len(tasks)
+
+                for next_answer in asyncio.as_completed(tasks):
+                    indices, text, error = await next_answer
+                    for index in indices:
+                        yield line(index, answer=text, error=error)
+            finally:
+                # The client went away: questions still waiting for a slot are dropped.
+                for task in tasks:
+                    task.cancel()
+
+        yield json.dumps({
+            'type': 'summary',
+            'queries': len(queries),
+            'llm_calls': llm_calls,
+            'search_ms': round(search_ms, 1),
+            'total_ms': round(search_ms + (time.perf_counter() - started) * 1000, 1),
+        }) + "\n"
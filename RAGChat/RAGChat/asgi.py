@@ -10,10 +10,13 @@ https://docs.djangoproject.com/en/6.0/howto/deployment/asgi/
 import os
 
 from django.core.asgi import get_asgi_application
-from channels.routing import ProtocolTypeRouter, URLRouter
+from channels.routing import ChannelNameRouter, ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 from channels.security.websocket import AllowedHostsOriginValidator
+from django.conf import settings
+import Chat.consumers
 import Chat.routing
+from Chat.cluster import search_channel_name
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'RAGChat.settings')
 
@@ -26,4 +29,11 @@ application = ProtocolTypeRouter({
             )
         )
     ),
+    "channel": ChannelNameRouter({
+        search_channel_name(settings.NODE_ID): Chat.consumers.SearchWorkerConsumer.as_asgi(),
+    }),
 })
+
+from Chat.maintenance import start_periodic_maintenance
+
+start_periodic_maintenance()
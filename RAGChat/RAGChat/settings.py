@@ -11,6 +11,9 @@ https://docs.djangoproject.com/en/6.0/ref/settings/
 """
 
 import os
+import socket
+
+from django.core.exceptions import ImproperlyConfigured
 
 
 from dotenv import load_dotenv
@@ -173,6 +176,86 @@ SIMPLE_JWT = {
     'REFRESH_TOKEN_LIFETIME': timedelta(days=1),
 }
 
+# Chunking: one of 'recursive', 'sentence', 'page', 'layout' or 'auto'
+# (compare them on your own PDFs with `manage.py benchmark_chunking`)
+CHUNK_STRATEGY = 'recursive'
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+
+# Loaded vector stores cached per worker process (payloads are memory-mapped and shared)
+VECTOR_STORE_CACHE_SIZE = 32
+
+# Profiling: staff can send `"debug": true` with a chat query or upload to profile it;
+# PROFILING_SAMPLE_RATE profiles that fraction of all requests. pstats files are kept
+# in PROFILING_DIR, oldest removed beyond PROFILING_MAX_FILES.
+PROFILING_DIR = BASE_DIR / 'profiles'
+PROFILING_SAMPLE_RATE = 0.0
+PROFILING_MAX_FILES = 200
+
+# Multi-node deployment. Set REDIS_URL to share the channel layer between nodes,
+# NODE_ID for this node and CLUSTER_NODES (comma separated) for every node mounting
+# the same MEDIA_ROOT. Each node also runs `manage.py runworker rag-search.<NODE_ID>`.
+REDIS_URL = os.getenv('REDIS_URL')
+if REDIS_URL:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {'hosts': [REDIS_URL]},
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        },
+    }
+
+NODE_ID = os.getenv('NODE_ID', socket.gethostname())
+CLUSTER_NODES = [node.strip() for node in os.getenv('CLUSTER_NODES', '').split(',') if node.strip()]
+if CLUSTER_NODES and not REDIS_URL:
+    # The in-memory layer is per process: routed searches would time out on every node.
+    raise ImproperlyConfigured("CLUSTER_NODES requires REDIS_URL for a shared channel layer")
+CLUSTER_SEARCH_TIMEOUT = 5
+CLUSTER_NODE_COOLDOWN = 30
+CLUSTER_WORKER_CONCURRENCY = 8
+
+# Batch question answering (POST /api/v1/batch/): concurrent LLM calls per process, shared by
+# all requests. Each query costs one token from a per-user bucket refilled at BATCH_USER_QUERY_RATE
+# per second and holding at most BATCH_MAX_QUERIES, which also caps the size of one request.
+# Batches amortise retrieval over all their questions, so this sits far above CHAT_USER_QUERY_RATE.
+BATCH_LLM_CONCURRENCY = 4
+BATCH_MAX_QUERIES = 5000
+BATCH_USER_QUERY_RATE = 50
+
+# Background cleanup of orphaned stores/uploads every N seconds (0 disables). Every worker checks,
+# but a lock file in MEDIA_ROOT lets only one of them run it per interval; set 0 and schedule
+# `manage.py cleanup_vector_stores` from cron instead if preferred. Items newer than the grace period are kept.
+VECTOR_STORE_GC_INTERVAL = 6 * 60 * 60
+VECTOR_STORE_GC_GRACE = 60 * 60
+
+# Retrieval: the TF-IDF top RAG_CANDIDATE_K are re-ranked within a time budget
+RAG_CANDIDATE_K = 20
+RAG_RERANK_BUDGET_MS = 30
+RAG_RERANK_BATCH_SIZE = 8
+RAG_RERANK_WEIGHT = 0.5
+
+# Per-connection chat history: recent turns within a token budget, older ones summarized
+CHAT_MEMORY_MAX_TURNS = 6
+CHAT_MEMORY_TOKEN_BUDGET = 1500
+CHAT_MEMORY_SUMMARY_TOKENS = 300
+
+# WebSocket query admission (per worker process): token buckets in queries/second,
+# a bounded wait queue, and load shedding beyond it. A socket may have CHAT_MAX_PENDING_QUERIES
+# queries in flight (running plus waiting); further ones are rejected straight away.
+CHAT_MAX_PENDING_QUERIES = 2
+CHAT_MAX_CONCURRENT_QUERIES = 8
+CHAT_MAX_QUEUED_QUERIES = 32
+CHAT_QUEUE_TIMEOUT = 30
+CHAT_USER_QUERY_RATE = 0.5
+CHAT_USER_QUERY_BURST = 5
+CHAT_GLOBAL_QUERY_RATE = 20
+CHAT_GLOBAL_QUERY_BURST = 40
+
 
 
 